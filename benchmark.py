@@ -0,0 +1,570 @@
+# Бенчмарк скорости и точности NLU на корпусе, собранном из каталога вопросов.
+# Запуск: python benchmark.py [--catalog Код/questions.json] [--repeat 5] [--output nlu.json] [--compare old.json]
+#         [--load 16] [--selection] [--storage] [--state]
+# Нужны те же переменные окружения, что и навыку (MONGODB_URL), база не используется.
+from dataclasses import dataclass, field
+from typing import Optional, Callable
+from unittest import mock
+import subprocess
+import types
+import argparse
+import platform
+import asyncio
+import logging
+import random
+import time
+import json
+import sys
+
+from aioalice.types import AliceRequest
+from pydantic import TypeAdapter
+import bson
+
+from models import UserCheck
+from metrics import LatencyStats
+from settings import settings
+from state import GameStates, State, commit_state
+from context import get_body
+import dispatch
+import executor
+import selection
+import routes
+import models
+import fuzzy
+import nlu
+
+PREFIXES = ("", "я думаю ", "наверное ", "это ", "мне кажется ")
+NUMBER_TEMPLATES = ("{}", "вариант {}", "ответ номер {}", "наверное {}")
+NEGATION_TEMPLATES = ("не {}", "точно не {}")
+NEGATION_CHOICE_TEMPLATES = ("не {} а {}", "точно не {} это {}")
+DISTRACTORS = (
+    "какая сегодня погода", "расскажи анекдот", "а сколько сейчас времени",
+    "мне надо подумать", "включи музыку", "ничего из этого", "я пойду пить чай"
+)
+SELECTION_CATALOG_SIZES = (100, 1000, 10000, 100000)
+SELECTION_HISTORY = (0.0, 0.5, 0.9)
+# validate - State.from_request до кэширования: проверка на каждом вызове, cached - один разбор на запрос
+STATE_MODES = ("validate", "cached")
+STAGES = ("tokenize", "lemmatize", "answer_index", "clean", "score", "check_user_answer", "filters")
+
+
+@dataclass(slots=True, frozen=True)
+class Case:
+    kind: str
+    utterance: str
+    question: str
+    answers: list[tuple[int, str]]
+    true_answer: int
+    # Ожидаемый номер ответа, None - ответ не должен быть выбран
+    expected: Optional[int] = None
+    # Номер ответа, который нельзя выбирать (отрицание)
+    forbidden: Optional[int] = None
+
+
+@dataclass(slots=True)
+class Score:
+    total: int = 0
+    correct: int = 0
+    ambiguous: int = 0
+    routing: dict[str, int] = field(default_factory=dict)
+
+
+def load_catalog(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def partial_word(text: str, clean: list[str]) -> Optional[str]:
+    """Самое длинное слово ответа, которое отличает его от других вариантов"""
+    if len(set(clean)) < 2:
+        return None
+    words = [token for token in nlu.tokenizer(text) if nlu.parse_word(token).normal_form in clean]
+    return max(words, key=len, default=None)
+
+
+def build_corpus(catalog: list[dict], seed: int = 0) -> list[Case]:
+    rnd = random.Random(seed)
+    cases = []
+    for position, question in enumerate(catalog):
+        question_id = f"q{position}"
+        answers = [(i, answer["text"]["src"]) for i, answer in enumerate(question["answers"], 1)]
+        true_answer = next(i for i, answer in enumerate(question["answers"], 1) if answer["is_true"])
+        index = nlu.build_answer_index(answers)
+
+        def add(kind: str, utterance: str, expected: Optional[int] = None, forbidden: Optional[int] = None):
+            cases.append(Case(kind, utterance, question_id, answers, true_answer, expected, forbidden))
+
+        for (number, text), clean in zip(answers, index.answers):
+            text = text.lower()
+            for prefix in PREFIXES:
+                add("exact", f"{prefix}{text}", expected=number)
+            word = partial_word(text, clean.clean)
+            if word is not None:
+                for prefix in PREFIXES:
+                    add("partial", f"{prefix}{word}", expected=number)
+            for template in NUMBER_TEMPLATES:
+                add("number", template.format(number), expected=number)
+            for template in NEGATION_TEMPLATES:
+                add("negated", template.format(text), forbidden=number)
+            other_number, other_text = rnd.choice([answer for answer in answers if answer[0] != number])
+            for template in NEGATION_CHOICE_TEMPLATES:
+                add("negated", template.format(text, other_text.lower()), expected=other_number, forbidden=number)
+        for utterance in DISTRACTORS:
+            add("distractor", utterance)
+    return cases
+
+
+def make_request(case: Case) -> AliceRequest:
+    body = {
+        "meta": {"locale": "ru-RU", "timezone": "UTC", "client_id": "benchmark", "interfaces": {}},
+        "session": {
+            "message_id": 1, "session_id": "benchmark", "skill_id": "benchmark", "user_id": "benchmark",
+            "user": {"user_id": "benchmark"}, "application": {"application_id": "benchmark"}, "new": False
+        },
+        "request": {
+            "command": case.utterance, "original_utterance": case.utterance, "type": "SimpleUtterance",
+            "nlu": {"tokens": case.utterance.split(), "entities": [], "intents": {}}
+        },
+        "state": {
+            "session": {
+                "current_answers": case.answers,
+                "current_true_answer": case.true_answer,
+                "current_question": case.question,
+                "state": GameStates.GUESS_ANSWER
+            },
+            "user": {}, "application": {}
+        },
+        "version": "1.0"
+    }
+    return AliceRequest(None, **body)
+
+
+def chosen_answer(result) -> Optional[int]:
+    if isinstance(result, UserCheck):
+        return result.diff.number if result.diff is not None else None
+    return None
+
+
+def is_correct(case: Case, result) -> bool:
+    if not isinstance(result, UserCheck):
+        return False
+    number = chosen_answer(result)
+    if case.forbidden is not None and number == case.forbidden:
+        return False
+    return number == case.expected
+
+
+def timed(samples: list[float], function: Callable, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    samples.append(time.perf_counter() - started)
+    return result
+
+
+async def first_handler(alice: AliceRequest) -> str:
+    """Имя обработчика, который выберет диспетчер; сам обработчик не вызывается"""
+    handler = routes.dp.requests_handlers
+    analysis = nlu.analyze(alice)
+    for record in handler.candidates(GameStates.GUESS_ANSWER, analysis.intents):
+        if await dispatch.IndexedHandler._check(record, (alice,), None):
+            return record.handler.__name__
+    return "-"
+
+
+async def run_filters(cases: list[Case], samples: list[float]) -> list[str]:
+    result = []
+    for case in cases:
+        alice = make_request(case)
+        started = time.perf_counter()
+        name = await first_handler(alice)
+        samples.append(time.perf_counter() - started)
+        result.append(name)
+    return result
+
+
+def score(case: Case, user_answer: str, index) -> list:
+    """Сравнение по тексту, по номеру и нечёткое - в том же порядке, что в check_user_answer"""
+    answers = list(index.answers)
+    diffs = nlu.calculate_correct_answer_by_text(user_answer, answers)
+    if not diffs:
+        diffs = nlu.calculate_correct_answer_by_number(user_answer, answers)
+    if not diffs and settings.fuzzy_matching:
+        diffs = nlu.calculate_correct_answer_by_fuzzy(
+            user_answer, answers, nlu.get_fuzzy_index(case.question, index)
+        )
+    return diffs
+
+
+def run(cases: list[Case], repeat: int) -> tuple[dict[str, list[float]], dict[str, Score]]:
+    samples = {stage: [] for stage in STAGES}
+    scores: dict[str, Score] = {}
+    nlu.lemma_cache.clear()
+    nlu.answer_index_cache.clear()
+    nlu.fuzzy_index_cache.clear()
+    loop = asyncio.new_event_loop()
+    try:
+        for iteration in range(repeat):
+            for case in cases:
+                tokens = timed(samples["tokenize"], nlu.tokenizer, case.utterance)
+                lemmas = timed(samples["lemmatize"], nlu.lemmatize, tokens)
+                index = timed(samples["answer_index"], nlu.get_answer_index, case.question, case.answers)
+                answers = list(index.answers)
+                user_answer = timed(
+                    samples["clean"], nlu.clean_user_command, lemmas, answers, index.common_words, index.patterns
+                )
+                timed(samples["score"], score, case, user_answer, index)
+                result = timed(samples["check_user_answer"], nlu.check_user_answer, make_request(case))
+
+                if iteration == 0:
+                    value = scores.setdefault(case.kind, Score())
+                    value.total += 1
+                    value.correct += is_correct(case, result)
+                    value.ambiguous += not isinstance(result, UserCheck)
+
+            routing = loop.run_until_complete(run_filters(cases, samples["filters"]))
+            if iteration == 0:
+                for case, name in zip(cases, routing):
+                    value = scores[case.kind]
+                    value.routing[name] = value.routing.get(name, 0) + 1
+    finally:
+        loop.close()
+    return samples, scores
+
+
+async def run_load(cases: list[Case], concurrency: int) -> dict:
+    """
+    Одновременные проверки ответов в текущем режиме executor.
+    Задержка цикла событий показывает, насколько проверка мешает остальным запросам
+    """
+    requests = LatencyStats(len(cases))
+    lag = LatencyStats(len(cases))
+    queue = asyncio.Queue()
+    for case in cases:
+        queue.put_nowait(case)
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lag.observe(max(0.0, time.perf_counter() - started - 0.001))
+
+    async def worker():
+        while not queue.empty():
+            alice = make_request(queue.get_nowait())
+            started = time.perf_counter()
+            await executor.check_user_answer(alice)
+            requests.observe(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    ticker_task = asyncio.create_task(ticker())
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await ticker_task
+    return {
+        "throughput_rps": round(len(cases) / elapsed, 1),
+        "request": requests.stats(),
+        "loop_lag": lag.stats(),
+        "operations": executor.stats()
+    }
+
+
+def run_executor_modes(cases: list[Case], concurrency: int, min_tokens: int) -> dict:
+    result = {}
+    settings.nlu_offload_min_tokens = min_tokens
+    for mode in executor.MODES:
+        settings.nlu_executor = mode
+        executor.latency.clear()
+        loop = asyncio.new_event_loop()
+        try:
+            # Первый прогон прогревает пул и кэши, замеряется второй
+            loop.run_until_complete(run_load(cases, concurrency))
+            executor.latency.clear()
+            result[mode] = loop.run_until_complete(run_load(cases, concurrency))
+            loop.run_until_complete(executor.shutdown())
+        finally:
+            loop.close()
+    return result
+
+
+def pick_legacy(ids: list[str], passed: list[str], rnd: random.Random) -> Optional[str]:
+    """Работа, которую делает база для $match {$nin: passed} + $sample: фильтр всего каталога и выбор"""
+    excluded = set(passed)
+    candidates = [question_id for question_id in ids if question_id not in excluded]
+    return rnd.choice(candidates) if candidates else None
+
+
+def run_selection(picks: int = 200, seed: int = 0) -> dict:
+    """
+    Стоимость выбора следующего вопроса при росте каталога и истории пользователя.
+    Для $nin + $sample замеряется эквивалентная работа в памяти, без сети и индексов базы
+    """
+    rnd = random.Random(seed)
+    result = {}
+    for size in SELECTION_CATALOG_SIZES:
+        ids = sorted(f"{i:024x}" for i in range(size))
+        for history in SELECTION_HISTORY:
+            passed = rnd.sample(ids, int(size * history))
+            user_data = types.SimpleNamespace(
+                passed_questions=[], selection_seed=seed, selection_cursor=len(passed), selection_size=size,
+                selection_verify=False
+            )
+            legacy = []
+            engine = []
+            for _ in range(picks):
+                timed(legacy, pick_legacy, ids, passed, rnd)
+                if user_data.selection_cursor >= size:
+                    user_data.selection_cursor = len(passed)
+                timed(engine, selection.next_question_id, user_data, ids)
+            result[f"{size}:{history}"] = {
+                "catalog": size,
+                "passed": len(passed),
+                "nin_sample": percentiles(legacy),
+                "cursor": percentiles(engine)
+            }
+    return result
+
+
+def print_selection_report(result: dict):
+    for values in result.values():
+        print(
+            f"catalog {values['catalog']:>7} passed {values['passed']:>7}: "
+            f"$nin+$sample p50 {values['nin_sample']['p50']:10.2f} us, cursor p50 {values['cursor']['p50']:6.2f} us"
+        )
+
+
+def load_progress(raw: bytes, adapters: dict[str, TypeAdapter]) -> dict:
+    """Чтение прогресса из ответа базы: декодирование BSON и проверка полей как в UserData"""
+    document = bson.decode(raw)
+    return {name: adapter.validate_python(document[name]) for name, adapter in adapters.items() if name in document}
+
+
+def run_storage(repeat: int = 5, seed: int = 0) -> dict:
+    """Размер документа пользователя и время его загрузки: список ObjectId против битов по Question.ordinal"""
+    rnd = random.Random(seed)
+    adapters = {
+        name: TypeAdapter(models.UserData.model_fields[name].annotation) for name in ("passed_questions", "passed")
+    }
+    result = {}
+    for size in SELECTION_CATALOG_SIZES:
+        ids = [bson.ObjectId() for _ in range(size)]
+        for history in SELECTION_HISTORY:
+            passed = rnd.sample(range(size), int(size * history))
+            documents = {
+                "list": {"user_id": "benchmark", "passed_questions": [ids[ordinal] for ordinal in passed]},
+                "bits": {"user_id": "benchmark", "passed": models.ordinal_words(passed)}
+            }
+            values = {"catalog": size, "passed": len(passed)}
+            for name, document in documents.items():
+                raw = bson.encode(document)
+                samples = []
+                for _ in range(repeat):
+                    timed(samples, load_progress, raw, adapters)
+                values[name] = {"bytes": len(raw), "load": percentiles(samples)}
+            result[f"{size}:{history}"] = values
+    return result
+
+
+def print_storage_report(result: dict):
+    for values in result.values():
+        print(
+            f"catalog {values['catalog']:>7} passed {values['passed']:>7}: "
+            f"list {values['list']['bytes']:>9} B {values['list']['load']['p50']:10.2f} us, "
+            f"bits {values['bits']['bytes']:>7} B {values['bits']['load']['p50']:8.2f} us"
+        )
+
+
+def validate_every_call(cls, alice: AliceRequest) -> State:
+    return cls(**get_body(alice)["state"])
+
+
+async def state_turn(alice: AliceRequest) -> dict:
+    """Стек обработчиков хода с непонятым ответом: проверка ответа, миксины обработчика и фиксация состояния"""
+    return commit_state(await routes.handler_quess_answer(alice), alice)
+
+
+async def run_state_mode(cases: list[Case], mode: str, repeat: int) -> dict:
+    parses = 0
+    original = validate_every_call if mode == "validate" else State.model_validate.__func__
+
+    def counted(cls, *args):
+        nonlocal parses
+        parses += 1
+        return original(cls, *args)
+
+    name = "from_request" if mode == "validate" else "model_validate"
+    with mock.patch.object(State, name, classmethod(counted)):
+        # Прогрев кэшей лемм и индексов ответов
+        for case in cases:
+            await state_turn(make_request(case))
+        parses = 0
+        samples = []
+        for _ in range(repeat):
+            for case in cases:
+                alice = make_request(case)
+                started = time.perf_counter()
+                await state_turn(alice)
+                samples.append(time.perf_counter() - started)
+    return {"turn": percentiles(samples), "parses_per_turn": round(parses / len(samples), 2)}
+
+
+def run_state(cases: list[Case], repeat: int) -> dict:
+    """Сколько стоит разбор состояния Алисы в стеке обработчиков одного хода, по режимам STATE_MODES"""
+    # Непонятые ответы не обращаются к каталогу: замер без базы
+    cases = [case for case in cases if case.kind == "distractor"]
+    loop = asyncio.new_event_loop()
+    try:
+        return {mode: loop.run_until_complete(run_state_mode(cases, mode, repeat)) for mode in STATE_MODES}
+    finally:
+        loop.close()
+
+
+def print_state_report(result: dict):
+    for mode, values in result.items():
+        print(
+            f"{mode:>8}: turn p50 {values['turn']['p50']:8.2f} us, p90 {values['turn']['p90']:8.2f} us, "
+            f"State parses per turn {values['parses_per_turn']}"
+        )
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def at(q: float) -> float:
+        return round(values[min(len(values) - 1, int(q * len(values)))] * 1e6, 2)
+
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values) * 1e6, 2),
+        "p50": at(0.50),
+        "p90": at(0.90),
+        "p99": at(0.99),
+        "max": round(values[-1] * 1e6, 2)
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(cases: list[Case], samples: dict[str, list[float]], scores: dict[str, Score], repeat: int) -> dict:
+    total = sum(value.total for value in scores.values())
+    correct = sum(value.correct for value in scores.values())
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "cases": len(cases),
+            "repeat": repeat,
+            "fuzzy_matching": settings.fuzzy_matching,
+            "fuzzy_threshold": settings.fuzzy_threshold
+        },
+        # Микросекунды
+        "latency_us": {stage: percentiles(values) for stage, values in samples.items()},
+        "accuracy": {
+            "overall": round(correct / total, 4) if total else 0.0,
+            **{
+                kind: {
+                    "total": value.total,
+                    "correct": value.correct,
+                    "ambiguous": value.ambiguous,
+                    "accuracy": round(value.correct / value.total, 4) if value.total else 0.0
+                }
+                for kind, value in scores.items()
+            }
+        },
+        "routing": {kind: value.routing for kind, value in scores.items()},
+        "caches": {
+            "lemma": nlu.lemma_cache.stats(),
+            "answer_index": nlu.answer_index_cache.stats(),
+            "fuzzy": fuzzy.stats.stats()
+        }
+    }
+
+
+def print_executor_report(result: dict):
+    for mode, values in result.items():
+        print(
+            f"{mode:>18}: {values['throughput_rps']:8.1f} rps, request p50 {values['request']['p50_ms']:.3f}"
+            f" p99 {values['request']['p99_ms']:.3f} ms, loop lag p99 {values['loop_lag']['p99_ms']:.3f}"
+            f" max {values['loop_lag']['max_ms']:.3f} ms"
+        )
+
+
+def print_report(result: dict, previous: Optional[dict] = None):
+    def delta(new: float, old: Optional[float]) -> str:
+        if not old:
+            return ""
+        return f" ({(new - old) / old * 100:+.1f}%)"
+
+    print(f"Cases: {result['meta']['cases']} x {result['meta']['repeat']}, commit {result['meta']['commit']}")
+    for stage, values in result["latency_us"].items():
+        old = previous["latency_us"].get(stage, {}) if previous else {}
+        print(
+            f"{stage:>18}: p50 {values['p50']:8.2f}{delta(values['p50'], old.get('p50'))}"
+            f"  p90 {values['p90']:8.2f}  p99 {values['p99']:8.2f}{delta(values['p99'], old.get('p99'))}"
+            f"  max {values['max']:9.2f} us"
+        )
+    for kind, values in result["accuracy"].items():
+        if kind == "overall":
+            continue
+        old = previous["accuracy"].get(kind, {}).get("accuracy") if previous else None
+        change = f" (was {old:.4f})" if old is not None and old != values["accuracy"] else ""
+        print(f"{kind:>18}: {values['correct']}/{values['total']} = {values['accuracy']:.4f}{change}"
+              f", ambiguous {values['ambiguous']}")
+    print(f"{'overall':>18}: {result['accuracy']['overall']:.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NLU benchmark on the question catalog")
+    parser.add_argument("--catalog", default="Код/questions.json")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file for the results")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    parser.add_argument("--load", type=int, default=0, help="Concurrency for the inline/thread/process comparison")
+    parser.add_argument("--load-min-tokens", type=int, default=0, help="NLU_OFFLOAD_MIN_TOKENS for the comparison")
+    parser.add_argument("--selection", action="store_true", help="Question selection cost by catalog and history size")
+    parser.add_argument("--storage", action="store_true", help="User progress document size and load time")
+    parser.add_argument("--state", action="store_true", help="Alice state parsing cost in the handler stack")
+    args = parser.parse_args()
+
+    # Логи проверки ответа на каждом вызове исказили бы замеры
+    logging.disable(logging.INFO)
+    cases = build_corpus(load_catalog(args.catalog), args.seed)
+    samples, scores = run(cases, args.repeat)
+    result = report(cases, samples, scores, args.repeat)
+
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            previous = json.load(file)
+    print_report(result, previous)
+    if args.load:
+        result["executor"] = run_executor_modes(cases, args.load, args.load_min_tokens)
+        print_executor_report(result["executor"])
+    if args.selection:
+        result["selection"] = run_selection(seed=args.seed)
+        print_selection_report(result["selection"])
+    if args.storage:
+        result["storage"] = run_storage(seed=args.seed)
+        print_storage_report(result["storage"])
+    if args.state:
+        result["state"] = run_state(cases, args.repeat * 20)
+        print_state_report(result["state"])
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(result, file, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
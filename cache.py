@@ -0,0 +1,110 @@
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+import threading
+import time
+
+
+class LRUCache:
+    """
+    Ограниченный по размеру кэш со статистикой попаданий.
+    eviction="lru" - вытесняется давно не использованная запись,
+    eviction="fifo" - вытесняется самая старая запись (попадание не двигает запись).
+    ttl - время жизни записи в секундах, None - без ограничения.
+    Доступен из нескольких потоков (пул NLU, см. executor.py)
+    """
+
+    def __init__(self, maxsize: int = 1024, eviction: str = "lru", ttl: Optional[float] = None):
+        if eviction not in ("lru", "fifo"):
+            raise ValueError(f"Unknown eviction policy {eviction!r}")
+        self.maxsize = maxsize
+        self.eviction = eviction
+        self.ttl = ttl
+        self.data: OrderedDict = OrderedDict()
+        # key -> момент устаревания по time.monotonic, только при ttl. В порядке set, то есть и устаревания
+        # (ttl один на кэш): очередь вытеснения data при lru упорядочена по обращениям
+        self.expires: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.ttl is not None and self.expires[key] <= time.monotonic():
+                del self.data[key]
+                del self.expires[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            if self.eviction == "lru":
+                self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+            self.data[key] = value
+            if self.ttl is not None:
+                self.expires[key] = time.monotonic() + self.ttl
+                self.expires.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                evicted, _ = self.data.popitem(last=False)
+                self.expires.pop(evicted, None)
+                self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            self.expires.pop(key, None)
+            return self.data.pop(key, default)
+
+    def expire_oldest(self) -> int:
+        """Удаляет устаревшие записи в порядке устаревания, до первой живой"""
+        if self.ttl is None:
+            return 0
+        expired = 0
+        now = time.monotonic()
+        with self._lock:
+            while self.expires:
+                key, deadline = next(iter(self.expires.items()))
+                if deadline > now:
+                    break
+                del self.data[key]
+                del self.expires[key]
+                expired += 1
+            self.expirations += expired
+        return expired
+
+    def clear(self):
+        with self._lock:
+            self.data.clear()
+            self.expires.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Как get, устаревшая запись считается отсутствующей; статистику и очередь вытеснения не меняет"""
+        with self._lock:
+            if key not in self.data:
+                return False
+            return self.ttl is None or self.expires[key] > time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
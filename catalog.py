@@ -0,0 +1,87 @@
+from typing import Awaitable, Callable, Optional, Union
+import asyncio
+import logging
+import time
+
+from beanie import PydanticObjectId
+
+from repository import repository
+from metrics import LatencyStats
+from settings import settings
+from cache import LRUCache
+import models
+
+QuestionId = Union[str, PydanticObjectId]
+
+
+class QuestionCatalog:
+    """
+    Кэш вопросов в памяти процесса перед repository.get_question.
+    Одновременные промахи по одному id ждут одно чтение из базы.
+    Закэшированный вопрос общий для всех запросов, изменять его нельзя
+    """
+
+    def __init__(self, loader: Callable[[str], Awaitable[Optional[models.Question]]],
+                 maxsize: int = 1000, ttl: Optional[float] = None):
+        self.loader = loader
+        self.cache = LRUCache(maxsize, ttl=ttl)
+        self.load_latency = LatencyStats()
+        # Ожидающие общего чтения запросы
+        self.collapsed = 0
+        self._loading: dict[str, asyncio.Task] = {}
+
+    async def get(self, question_id: QuestionId) -> Optional[models.Question]:
+        key = str(question_id)
+        question = self.cache.get(key)
+        if question is not None:
+            return question
+
+        task = self._loading.get(key)
+        if task is None:
+            task = self._loading[key] = asyncio.ensure_future(self._load(key))
+            task.add_done_callback(lambda _: self._loading.pop(key, None))
+        else:
+            self.collapsed += 1
+        # shield: отмена одного запроса не отменяет чтение для остальных
+        return await asyncio.shield(task)
+
+    async def _load(self, key: str) -> Optional[models.Question]:
+        started = time.perf_counter()
+        question = await self.loader(key)
+        self.load_latency.observe(time.perf_counter() - started)
+        if question is not None:
+            self.cache.set(key, question)
+        return question
+
+    def put(self, question: models.Question):
+        """Вопрос уже прочитан из базы (например, выбран случайно) и пригодится на следующих шагах"""
+        self.cache.set(str(question.id), question)
+
+    def invalidate(self, question_id: Optional[QuestionId] = None):
+        """Сбрасывает один вопрос или весь каталог, следующее обращение прочитает базу"""
+        if question_id is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(str(question_id))
+
+    async def reload(self, question_id: Optional[QuestionId] = None) -> int:
+        """Перечитывает из базы один вопрос или все закэшированные, возвращает число загруженных"""
+        keys = list(self.cache.data) if question_id is None else [str(question_id)]
+        for key in keys:
+            self.cache.pop(key)
+        questions = await asyncio.gather(*(self.get(key) for key in keys))
+        return sum(question is not None for question in questions)
+
+    def stats(self) -> dict:
+        return {
+            **self.cache.stats(),
+            "collapsed": self.collapsed,
+            "load": self.load_latency.stats()
+        }
+
+
+catalog = QuestionCatalog(repository.get_question, settings.question_cache_size, settings.question_cache_ttl)
+
+
+async def log_stats(*_):
+    logging.info(f"Question catalog cache: {catalog.stats()}")
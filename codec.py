@@ -0,0 +1,76 @@
+from dataclasses import dataclass
+from typing import Any, Callable, Union
+import json
+
+from settings import settings
+
+
+@dataclass(slots=True, frozen=True)
+class Codec:
+    name: str
+    dumps: Callable[[Any], bytes]
+    loads: Callable[[Union[str, bytes]], Any]
+
+
+def _json_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+CODECS: dict[str, Codec] = {
+    "json": Codec("json", _json_dumps, json.loads)
+}
+
+try:
+    import orjson
+
+    CODECS["orjson"] = Codec("orjson", orjson.dumps, orjson.loads)
+except ImportError:
+    pass
+
+try:
+    import ujson
+
+    CODECS["ujson"] = Codec(
+        "ujson",
+        lambda obj: ujson.dumps(obj, ensure_ascii=False).encode(),
+        ujson.loads
+    )
+except ImportError:
+    pass
+
+
+def get_codec(name: str) -> Codec:
+    if name not in CODECS:
+        raise ValueError(f"Unknown JSON codec {name!r}, available: {', '.join(CODECS)}")
+    return CODECS[name]
+
+
+codec = get_codec(settings.json_codec)
+
+
+if __name__ == '__main__':
+    import timeit
+
+    body = {
+        "response": {
+            "text": "Станция Древняя Македония! Осторожно, двери открываются! " * 4,
+            "tts": "Варианты ответов: \n1-й Аристотель \n2-й Антиген \n3-й Платон",
+            "buttons": [
+                {"title": title, "payload": {"is_true": i == 1, "number": i, "text": title}, "hide": False}
+                for i, title in enumerate(("Аристотель", "Антиген", "Платон"), 1)
+            ],
+            "end_session": False
+        },
+        "session": {"session_id": "2eac4854-fce721f3", "message_id": 4, "user_id": "AC9WC3DF6FCE052E45A4"},
+        "session_state": {
+            "current_answers": [[1, "Аристотель"], [2, "Антиген"], [3, "Платон"]],
+            "current_true_answer": 1, "current_question": "640dd396fda67cd71b9c9f3a",
+            "question_passed": 3, "number_of_hints": 4, "try_number": 0, "score": 2, "state": "guess_answer"
+        },
+        "version": "1.0"
+    }
+    raw = CODECS["json"].dumps(body)
+    for name, item in CODECS.items():
+        dumps = min(timeit.repeat(lambda: item.dumps(body), number=10000, repeat=5))
+        loads = min(timeit.repeat(lambda: item.loads(raw), number=10000, repeat=5))
+        print(f"{name:>8}: dumps {dumps * 100:.2f} us, loads {loads * 100:.2f} us, size {len(item.dumps(body))} b")
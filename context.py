@@ -0,0 +1,45 @@
+from typing import Optional
+
+from aioalice.types import AliceRequest
+from aiohttp.web_request import Request
+
+from codec import codec
+
+# Ключи request-scoped контекста aiohttp (request[...])
+BODY_KEY = "alice_body"
+BODY_DECODE_COUNT_KEY = "alice_body_decode_count"
+HANDLER_KEY = "alice_handler"
+
+
+async def read_body(request: Request) -> dict:
+    """Декодирует тело запроса один раз и кладёт его в контекст запроса"""
+    if BODY_KEY not in request:
+        request[BODY_DECODE_COUNT_KEY] = request.get(BODY_DECODE_COUNT_KEY, 0) + 1
+        request[BODY_KEY] = await request.json(loads=codec.loads)
+    return request[BODY_KEY]
+
+
+def get_body(alice: AliceRequest) -> dict:
+    """Уже декодированное тело запроса, из которого собран AliceRequest"""
+    request = alice.original_request
+    if request is not None and BODY_KEY in request:
+        return request[BODY_KEY]
+    return alice._raw_kwargs
+
+
+def get_decode_count(request: Request) -> int:
+    return request.get(BODY_DECODE_COUNT_KEY, 0)
+
+
+def set_handler(alice: AliceRequest, name: str):
+    """
+    Обработчик запроса для log_middleware: aioalice запускает диспетчер в отдельной задаче,
+    и current_handler из неё в middleware не возвращается
+    """
+    request = alice.original_request
+    if request is not None:
+        request[HANDLER_KEY] = name
+
+
+def get_handler(request: Request) -> Optional[str]:
+    return request.get(HANDLER_KEY, None)
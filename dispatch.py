@@ -0,0 +1,155 @@
+from dataclasses import dataclass
+from typing import Callable, Optional
+import logging
+
+from aioalice.dispatcher.filters import Filter, StateFilter, check_filter
+from aioalice.dispatcher.handler import Handler, SkipHandler
+from aioalice.types import AliceRequest
+
+from settings import settings
+import executor
+import filters
+
+
+@dataclass(slots=True, frozen=True)
+class IndexedRecord:
+    position: int
+    handler: Callable
+    # Фильтры в порядке возрастания стоимости
+    filters: tuple[Filter, ...]
+    # None - подходит для любого состояния / набора интентов
+    states: Optional[frozenset[str]]
+    intents: Optional[frozenset[str]]
+
+
+def describe(filter: Filter) -> str:
+    name = type(filter).__name__
+    if isinstance(filter, filters.IntentFilter):
+        return f"{name}({', '.join(filter.intent_names)})"
+    if isinstance(filter, filters.TextContainFilter):
+        return f"{name}({', '.join(sorted(filter.init_tokens))})"
+    if isinstance(filter, (filters.SessionState, StateFilter)):
+        return f"{name}({filter.state})"
+    if isinstance(filter, (filters.OneOfFilter, filters.AndFilter)):
+        return f"{name}({', '.join(map(describe, filter.filters))})"
+    return name
+
+
+def _required_states(record_filters: list[Filter]) -> Optional[frozenset[str]]:
+    for filter in record_filters:
+        if isinstance(filter, filters.SessionState):
+            return frozenset((filter.state,))
+        if isinstance(filter, filters.OneOfFilter) and filter.filters \
+                and all(isinstance(value, filters.SessionState) for value in filter.filters):
+            return frozenset(value.state for value in filter.filters)
+    return None
+
+
+def _required_intents(record_filters: list[Filter]) -> Optional[frozenset[str]]:
+    # Достаточно одного интент-фильтра: без хотя бы одного его интента обработчик не подойдёт
+    for filter in record_filters:
+        if isinstance(filter, filters.IntentFilter):
+            return frozenset(filter.intent_names)
+    return None
+
+
+class IndexedHandler(Handler):
+    """
+    Обработчик запросов aioalice с индексом по состоянию FSM и интентам.
+    Кандидаты сужаются по состоянию сессии и интентам запроса, порядок регистрации
+    (приоритет) сохраняется, фильтры кандидата проверяются от дешёвых к дорогим.
+    """
+
+    def __init__(self, trace: bool = False):
+        super().__init__()
+        self.trace = trace
+        self._records: Optional[list[IndexedRecord]] = None
+        # Кандидаты по состояниям из фильтров обработчиков; прочие состояния - только обработчики без фильтра состояния
+        self._by_state: dict[str, list[IndexedRecord]] = {}
+        self._any_state: list[IndexedRecord] = []
+
+    def register(self, handler, filters=None, index=None):
+        super().register(handler, filters, index)
+        self._records = None
+
+    def unregister(self, handler):
+        self._records = None
+        return super().unregister(handler)
+
+    def _build(self) -> list[IndexedRecord]:
+        records = []
+        for position, (record_filters, handler) in enumerate(self.handlers):
+            record_filters = list(record_filters or [])
+            records.append(IndexedRecord(
+                position=position,
+                handler=handler,
+                filters=tuple(sorted(record_filters, key=filters.get_cost)),
+                states=_required_states(record_filters),
+                intents=_required_intents(record_filters)
+            ))
+        self._records = records
+        # Ключи только из фильтров: состояние приходит от клиента, кэш по нему рос бы без ограничения
+        known = set().union(*(record.states for record in records if record.states is not None))
+        self._by_state = {
+            state: [record for record in records if record.states is None or state in record.states]
+            for state in known
+        }
+        self._any_state = [record for record in records if record.states is None]
+        return records
+
+    def candidates(self, state: str, intents: set[str]) -> list[IndexedRecord]:
+        if self._records is None:
+            self._build()
+        by_state = self._by_state.get(state, self._any_state) if isinstance(state, str) else self._any_state
+        return [
+            record for record in by_state
+            if record.intents is None or not record.intents.isdisjoint(intents)
+        ]
+
+    async def notify(self, *args):
+        alice: AliceRequest = args[0]
+        trace = [] if self.trace else None
+        try:
+            analysis = await executor.prepare_analysis(alice)
+            for record in self.candidates(filters.get_session_state(alice), analysis.intents):
+                if await self._check(record, args, trace):
+                    try:
+                        return await record.handler(*args)
+                    except SkipHandler:
+                        continue
+        finally:
+            if trace is not None:
+                alice.__dict__["_dispatch_trace"] = trace
+                logging.info(f"User: {alice.session.user_id}: Dispatch trace:\n{format_trace(trace)}")
+
+    @staticmethod
+    async def _check(record: IndexedRecord, args: tuple, trace: Optional[list]) -> bool:
+        for filter in record.filters:
+            result = await check_filter(filter, args)
+            if trace is not None:
+                trace.append((record.handler.__name__, describe(filter), bool(result)))
+            if not result:
+                return False
+        if trace is not None and not record.filters:
+            trace.append((record.handler.__name__, "-", True))
+        return True
+
+
+def get_trace(alice: AliceRequest) -> list[tuple[str, str, bool]]:
+    """Проверенные фильтры последнего запроса: (обработчик, фильтр, результат)"""
+    return alice.__dict__.get("_dispatch_trace", [])
+
+
+def format_trace(trace: list[tuple[str, str, bool]]) -> str:
+    return "\n".join(
+        f"{'+' if result else '-'} {handler}: {filter}"
+        for handler, filter, result in trace
+    )
+
+
+def install(dispatcher) -> IndexedHandler:
+    handler = IndexedHandler(trace=settings.dispatch_trace)
+    for record_filters, callback in dispatcher.requests_handlers.handlers:
+        handler.register(callback, record_filters)
+    dispatcher.requests_handlers = handler
+    return handler
@@ -0,0 +1,114 @@
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Any, Callable, Optional, Union
+import asyncio
+import logging
+import time
+
+from aioalice.types import AliceRequest
+
+from models import UserCheck, Diff
+from metrics import LatencyStats
+from settings import settings
+from state import State
+from fuzzy import FuzzyStats
+import logger
+import fuzzy
+import nlu
+
+MODES = ("inline", "thread", "process")
+
+_pool: Optional[Executor] = None
+
+
+# "операция:режим" -> задержка
+latency: dict[str, LatencyStats] = {}
+
+
+def get_pool() -> Executor:
+    """Пул создаётся при первом обращении, то есть уже в воркере gunicorn, а не в мастере"""
+    global _pool
+    if _pool is None:
+        if settings.nlu_executor == "thread":
+            _pool = ThreadPoolExecutor(max_workers=settings.nlu_executor_workers, thread_name_prefix="nlu")
+        elif settings.nlu_executor == "process":
+            _pool = ProcessPoolExecutor(max_workers=settings.nlu_executor_workers, initializer=logger.after_fork)
+        else:
+            raise ValueError(f"Unknown NLU executor {settings.nlu_executor!r}")
+    return _pool
+
+
+def choose_mode(size: int) -> str:
+    if settings.nlu_executor == "inline" or size < settings.nlu_offload_min_tokens:
+        return "inline"
+    return settings.nlu_executor
+
+
+def run_counted(function: Callable, *args) -> tuple[Any, FuzzyStats, int, int]:
+    """
+    Выполняется в процессе пула: счётчики нечёткой стадии и кэша лемм этого процесса
+    возвращаются вместе с результатом, иначе они не попали бы в статистику воркера
+    """
+    fuzzy.stats = FuzzyStats()
+    hits, misses = nlu.lemma_cache.hits, nlu.lemma_cache.misses
+    result = function(*args)
+    return result, fuzzy.stats, nlu.lemma_cache.hits - hits, nlu.lemma_cache.misses - misses
+
+
+async def run(operation: str, size: int, function: Callable, *args):
+    """Выполняет function в цикле событий или в пуле, в зависимости от режима и размера команды"""
+    mode = choose_mode(size)
+    started = time.perf_counter()
+    if mode == "inline":
+        result = function(*args)
+    elif mode == "thread":
+        result = await asyncio.get_running_loop().run_in_executor(get_pool(), function, *args)
+    else:
+        result, fuzzy_stats, hits, misses = await asyncio.get_running_loop().run_in_executor(
+            get_pool(), run_counted, function, *args
+        )
+        fuzzy.stats.merge(fuzzy_stats)
+        nlu.lemma_cache.hits += hits
+        nlu.lemma_cache.misses += misses
+    latency.setdefault(f"{operation}:{mode}", LatencyStats()).observe(time.perf_counter() - started)
+    return result
+
+
+async def prepare_analysis(alice: AliceRequest) -> nlu.Analysis:
+    """
+    Длинная команда при NLU_EXECUTOR=thread/process лемматизируется в пуле до выбора обработчика,
+    чтобы фильтры брали уже готовые леммы. Иначе Analysis.lemmas считается лениво, только если понадобится
+    """
+    analysis = nlu.analyze(alice)
+    if "lemmas" not in analysis.__dict__ and choose_mode(len(analysis.tokens)) != "inline":
+        analysis.lemmas = await run("lemmatize", len(analysis.tokens), nlu.lemmatize, analysis.tokens)
+    return analysis
+
+
+async def check_user_answer(alice: AliceRequest) -> Union[UserCheck, list[Diff]]:
+    if alice.request.type == "ButtonPressed":
+        return nlu.check_user_answer(alice)
+    analysis = await prepare_analysis(alice)
+    session = State.from_request(alice).session
+    size = len(analysis.tokens)
+    if choose_mode(size) != "process":
+        return await run("check_user_answer", size, nlu.check_answer_by_lemmas, session, analysis.lemmas)
+
+    # Кэши процесса пула пусты: индексы ответов берутся из кэша воркера, где handler_question
+    # построил их по леммам, посчитанным при импорте
+    index = nlu.get_answer_index(session.current_question, session.current_answers)
+    ngram_index = nlu.get_fuzzy_index(session.current_question, index) if settings.fuzzy_matching else None
+    return await run(
+        "check_user_answer", size, nlu.check_answer_by_lemmas, session, analysis.lemmas, index, ngram_index
+    )
+
+
+def stats() -> dict:
+    return {key: value.stats() for key, value in sorted(latency.items())}
+
+
+async def shutdown(*_):
+    global _pool
+    logging.info(f"NLU executor latency: {stats()}")
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
@@ -3,8 +3,12 @@ import enum
 from aioalice.dispatcher.filters import Filter, StateFilter, check_filter, AsyncFilter
 from aioalice.types import AliceRequest
 
+from context import get_body
 import nlu
 
+# Ключевые слова фильтров, по ним прогревается кэш лемм
+KEYWORDS: set[str] = {"подсказка"}
+
 
 class StateType(enum.Enum):
     SESSION = "session"
@@ -12,71 +16,88 @@ class StateType(enum.Enum):
     APPLICATION = "application"
 
 
-def _check_included_intent_names(alice: AliceRequest, intent_names: list[str]):
-    intents: dict = alice.request.nlu._raw_kwargs["intents"]
-    return any([intent_name in intents.keys() for intent_name in intent_names])
+def _check_included_intent_names(alice: AliceRequest, intent_names: tuple[str, ...]):
+    return not nlu.analyze(alice).intents.isdisjoint(intent_names)
 
 
-class NextFilter(Filter):
-    def check(self, alice: AliceRequest):
-        return _check_included_intent_names(alice, ["YANDEX.BOOK.NAVIGATION.NEXT"])
+def get_cost(filter: Filter) -> int:
+    """Оценка стоимости фильтра: сначала проверяются дешёвые"""
+    if isinstance(filter, StateFilter):
+        return 0
+    return getattr(filter, "cost", 1)
 
 
-class ConfirmFilter(Filter):
-    def check(self, alice: AliceRequest):
-        return _check_included_intent_names(alice, ["YANDEX.CONFIRM", "YANDEX.BOOK.NAVIGATION.NEXT", "AGREE"])
+def get_session_state(alice: AliceRequest) -> str:
+    return get_body(alice)["state"].get("session", {}).get("state", "*")
 
 
-class RejectFilter(Filter):
+class IntentFilter(Filter):
+    intent_names: tuple[str, ...] = ()
+    cost = 0
+
     def check(self, alice: AliceRequest):
-        return _check_included_intent_names(alice, ["YANDEX.REJECT", "REFUSAL"])
+        return _check_included_intent_names(alice, self.intent_names)
 
 
-class RepeatFilter(Filter):
-    def check(self, alice: AliceRequest):
-        return _check_included_intent_names(alice, ["YANDEX.REPEAT", "REPEAT"])
+class NextFilter(IntentFilter):
+    intent_names = ("YANDEX.BOOK.NAVIGATION.NEXT",)
 
 
-class HelpFilter(Filter):
-    def check(self, alice: AliceRequest):
-        return _check_included_intent_names(alice, ["YANDEX.HELP", "HELP"]) \
-               and "подсказка" not in nlu.lemmatize(alice.request.nlu.tokens)
+class ConfirmFilter(IntentFilter):
+    intent_names = ("YANDEX.CONFIRM", "YANDEX.BOOK.NAVIGATION.NEXT", "AGREE")
 
 
-class RestartFilter(Filter):
-    def check(self, alice: AliceRequest):
-        return _check_included_intent_names(alice, ["RESTART"])
+class RejectFilter(IntentFilter):
+    intent_names = ("YANDEX.REJECT", "REFUSAL")
 
 
-class EndFilter(Filter):
-    def check(self, alice: AliceRequest):
-        return _check_included_intent_names(alice, ["END"])
+class RepeatFilter(IntentFilter):
+    intent_names = ("YANDEX.REPEAT", "REPEAT")
+
 
+class HelpFilter(IntentFilter):
+    intent_names = ("YANDEX.HELP", "HELP")
+    cost = 1
 
-class CanDoFilter(Filter):
     def check(self, alice: AliceRequest):
-        return _check_included_intent_names(alice, ["WHATCANDO", "YANDEX.WHAT_CAN_YOU_DO"])
+        return _check_included_intent_names(alice, self.intent_names) \
+               and "подсказка" not in nlu.analyze(alice).lemma_set
+
+
+class RestartFilter(IntentFilter):
+    intent_names = ("RESTART",)
+
+
+class EndFilter(IntentFilter):
+    intent_names = ("END",)
+
+
+class CanDoFilter(IntentFilter):
+    intent_names = ("WHATCANDO", "YANDEX.WHAT_CAN_YOU_DO")
 
 
 class StartFilter(Filter):
+    cost = 0
+
     def check(self, alice: AliceRequest):
         return alice.session.new
 
 
 class TextContainFilter(Filter):
+    cost = 2
+
     def __init__(self, initial_tokens: list[str]):
-        self.init_tokens = nlu.lemmatize(initial_tokens)
+        KEYWORDS.update(initial_tokens)
+        self.init_tokens = set(nlu.lemmatize(initial_tokens))
 
     def check(self, alice: AliceRequest):
-        user_tokens = nlu.lemmatize(
-            nlu.tokenizer(alice.request.command)
-        )
-        return nlu.calculate_coincidence(user_tokens, self.init_tokens) > 0.75
+        return nlu.calculate_coincidence(nlu.analyze(alice).lemma_set, self.init_tokens) > 0.75
 
 
 class OneOfFilter(AsyncFilter):
     def __init__(self, *filters: Filter):
-        self.filters = filters
+        self.filters = sorted(filters, key=get_cost)
+        self.cost = max(map(get_cost, filters), default=0)
 
     async def check(self, alice: AliceRequest):
         for filter in self.filters:
@@ -87,19 +108,21 @@ class OneOfFilter(AsyncFilter):
 
 class AndFilter(AsyncFilter):
     def __init__(self, *filters: Filter):
-        self.filters = filters
+        self.filters = sorted(filters, key=get_cost)
+        self.cost = max(map(get_cost, filters), default=0)
 
     async def check(self, alice: AliceRequest):
-        result = []
         for filter in self.filters:
-            result.append(await check_filter(filter, (alice,)))
-        return all([result])
+            if not await check_filter(filter, (alice,)):
+                return False
+        return True
 
 
 class SessionState(Filter):
+    cost = 0
+
     def __init__(self, state: str):
         self.state = state
 
     def check(self, alice: AliceRequest):
-        state = alice._raw_kwargs["state"].get("session", {}).get("state", "*")
-        return self.state == state
+        return self.state == get_session_state(alice)
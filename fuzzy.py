@@ -0,0 +1,122 @@
+from typing import Iterable, Optional
+
+
+def ngrams(word: str, n: int = 3) -> set[str]:
+    """Символьные n-граммы слова с границами: " мальтиец " -> {" ма", "мал", ...}"""
+    padded = f" {word} "
+    if len(padded) <= n:
+        return {padded}
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+
+def edit_distance(a: str, b: str, limit: Optional[int] = None) -> int:
+    """
+    Расстояние Левенштейна с перестановкой соседних букв.
+    Если расстояние заведомо больше limit, возвращается limit + 1
+    """
+    if limit is not None and abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if limit is not None and min(current) > limit:
+            return limit + 1
+        previous_previous, previous = previous, current
+    return previous[-1]
+
+
+def similarity(a: str, b: str, threshold: float = 0.0) -> float:
+    """1 - расстояние / длина большего слова"""
+    length = max(len(a), len(b))
+    if not length:
+        return 1.0
+    limit = int(length * (1 - threshold))
+    distance = edit_distance(a, b, limit)
+    return 0.0 if distance > limit else 1 - distance / length
+
+
+class NgramIndex:
+    """
+    Индекс слов по символьным n-граммам.
+    Расстояние считается только для нескольких слов с наибольшим числом общих n-грамм,
+    поэтому стоимость поиска не зависит от размера словаря
+    """
+
+    def __init__(self, words: Iterable[str], n: int = 3):
+        self.n = n
+        self.words: set[str] = set()
+        self.grams: dict[str, set[str]] = {}
+        for word in words:
+            self.add(word)
+
+    def add(self, word: str):
+        if word in self.words:
+            return
+        self.words.add(word)
+        for gram in ngrams(word, self.n):
+            self.grams.setdefault(gram, set()).add(word)
+
+    def candidates(self, word: str, limit: int = 5) -> list[str]:
+        shared = {}
+        for gram in ngrams(word, self.n):
+            for candidate in self.grams.get(gram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+        return sorted(shared, key=lambda candidate: (-shared[candidate], candidate))[:limit]
+
+    def match(self, word: str, threshold: float, limit: int = 5) -> Optional[tuple[str, float]]:
+        """Ближайшее слово индекса и его сходство, если сходство не ниже порога"""
+        if word in self.words:
+            return word, 1.0
+        best = None
+        for candidate in self.candidates(word, limit):
+            score = similarity(word, candidate, threshold)
+            if score >= threshold and (best is None or score > best[1]):
+                best = candidate, score
+        return best
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+
+class FuzzyStats:
+    """Счётчики нечёткой стадии: вызовы, исправленные фразы, найденные ответы и время"""
+
+    def __init__(self):
+        self.calls = 0
+        self.corrected = 0
+        self.matched = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def observe(self, elapsed: float, corrected: bool, matched: bool):
+        self.calls += 1
+        self.corrected += corrected
+        self.matched += matched
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+    def merge(self, other: "FuzzyStats"):
+        """Счётчики, набранные в другом процессе (пул NLU_EXECUTOR=process)"""
+        self.calls += other.calls
+        self.corrected += other.corrected
+        self.matched += other.matched
+        self.total_time += other.total_time
+        self.max_time = max(self.max_time, other.max_time)
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "corrected": self.corrected,
+            "matched": self.matched,
+            "avg_ms": round(self.total_time / self.calls * 1000, 4) if self.calls else 0.0,
+            "max_ms": round(self.max_time * 1000, 4)
+        }
+
+
+stats = FuzzyStats()
@@ -0,0 +1,61 @@
+# Конфигурация gunicorn: приложение и статические данные (словари pymorphy2, кэш лемм)
+# загружаются в мастере до fork, куча замораживается, и воркеры делят страницы copy-on-write.
+import logging
+import os
+import gc
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:3000")
+# Больше одного воркера - с REPEAT_MODE=session, иначе повтор ответа зависит от того, какой воркер примет ход
+workers = int(os.getenv("WORKERS", "1"))
+worker_class = "aiohttp.GunicornWebWorker"
+preload_app = os.getenv("PRELOAD", "true").lower() in ("1", "true", "yes")
+
+if preload_app:
+    # Сборщик мусора не должен трогать объекты мастера до fork, иначе страницы копируются
+    gc.disable()
+
+
+def memory_usage() -> dict[str, int]:
+    """Память процесса в КБ из /proc/self/smaps_rollup: уникальная (USS), общая и PSS"""
+    values = {}
+    try:
+        with open("/proc/self/smaps_rollup") as file:
+            for line in file:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == "kB":
+                    values[parts[0].rstrip(":")] = int(parts[1])
+    except OSError:
+        return {}
+    return {
+        "rss": values.get("Rss", 0),
+        "pss": values.get("Pss", 0),
+        "unique": values.get("Private_Clean", 0) + values.get("Private_Dirty", 0),
+        "shared": values.get("Shared_Clean", 0) + values.get("Shared_Dirty", 0),
+    }
+
+
+def format_memory(usage: dict[str, int]) -> str:
+    if not usage:
+        return "memory usage is not available"
+    return ", ".join(f"{key} {value / 1024:.1f} MB" for key, value in usage.items())
+
+
+def when_ready(server):
+    if preload_app:
+        gc.freeze()
+        # Замороженные объекты сборщик не обходит, мастер дальше собирает только новые циклы
+        gc.enable()
+    server.log.info(f"Master {os.getpid()}: {format_memory(memory_usage())}")
+
+
+def post_fork(server, worker):
+    gc.enable()
+    import logger
+    logger.after_fork()
+
+
+def post_worker_init(worker):
+    # Диспетчер создан при импорте в мастере, в воркере он должен работать в его event loop
+    from routes import dp
+    dp.loop = worker.loop
+    logging.info(f"Worker {worker.pid}: {format_memory(memory_usage())}")
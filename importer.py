@@ -0,0 +1,187 @@
+"""
+Потоковый импорт каталога вопросов (как Код/questions.json) в базу.
+Запуск: MONGODB_URL=... python importer.py Код/questions.json [--batch-size N] [--dry-run] [--rejected PATH]
+"""
+from typing import Any, Iterator, Optional, TextIO
+import argparse
+import hashlib
+import asyncio
+import logging
+import time
+import json
+
+from pydantic import ValidationError
+from pymongo import UpdateOne
+
+from catalog import catalog
+import selection
+import logger
+import models
+import nlu
+
+CHUNK_SIZE = 1 << 16
+# Поля, которые импорт не перезаписывает: их выдаёт база
+SERVER_FIELDS = {"id", "revision_id", "ordinal", "key", "content_hash"}
+
+
+def iter_entries(file: TextIO, chunk_size: int = CHUNK_SIZE) -> Iterator[Any]:
+    """
+    Значения верхнего уровня JSON-массива (или потока значений, как в JSON Lines) по одному,
+    в памяти только текущий кусок файла
+    """
+    decoder = json.JSONDecoder()
+    buffer, position, eof = "", 0, False
+    while True:
+        while position < len(buffer) and (buffer[position].isspace() or buffer[position] in "[],"):
+            position += 1
+        if position == len(buffer) and eof:
+            return
+        try:
+            if position == len(buffer):
+                raise json.JSONDecodeError("Need more data", buffer, position)
+            value, end = decoder.raw_decode(buffer, position)
+            # Число на границе куска могло быть прочитано не полностью
+            incomplete = end == len(buffer) and not eof
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            incomplete = True
+        if incomplete:
+            chunk = file.read(chunk_size)
+            eof = not chunk
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        yield value
+        position = end
+
+
+def question_key(entry: dict) -> str:
+    """Ключ вопроса: явный key из файла или хэш короткого текста"""
+    if entry.get("key"):
+        return str(entry["key"])
+    return hashlib.sha1(entry["short_text"]["src"].strip().lower().encode()).hexdigest()
+
+
+def content_hash(document: dict) -> str:
+    return hashlib.sha1(json.dumps(document, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+def prepare_question(entry: Any) -> dict:
+    """Проверенный документ вопроса с посчитанными полями NLU, ValueError - вопрос отклонён"""
+    if not isinstance(entry, dict):
+        raise ValueError(f"Expected an object, got {type(entry).__name__}")
+    question = models.build_document(models.Question, entry)
+    if not question.answers:
+        raise ValueError("No answers")
+    if sum(answer.is_true for answer in question.answers) != 1:
+        raise ValueError("Exactly one answer must be true")
+
+    for answer in question.answers:
+        answer.lemmas = nlu.lemmatize(nlu.tokenizer(answer.text.src))
+    question.common_words = sorted(nlu.find_common_lemmas([set(answer.lemmas) for answer in question.answers]))
+    # Text.tts уже заполнен значением src там, где его не было
+    document = question.model_dump(exclude=SERVER_FIELDS)
+    document["content_hash"] = content_hash(document)
+    document["key"] = question_key(entry)
+    return document
+
+
+def describe_error(error: Exception) -> str:
+    if isinstance(error, ValidationError):
+        return "; ".join(f"{'.'.join(map(str, item['loc']))}: {item['msg']}" for item in error.errors())
+    return str(error)
+
+
+async def write_batch(batch: list[dict], report: dict, dry_run: bool = False):
+    """Upsert по key одним bulk_write, неизменённые вопросы (тот же content_hash) пропускаются"""
+    collection = models.Question.get_motor_collection()
+    keys = [document["key"] for document in batch]
+    short_texts = [document["short_text"]["src"] for document in batch]
+    existing, legacy = {}, {}
+    query = {"$or": [{"key": {"$in": keys}}, {"key": None, "short_text.src": {"$in": short_texts}}]}
+    async for document in collection.find(query, {"key": 1, "content_hash": 1, "short_text.src": 1}):
+        if document.get("key"):
+            existing[document["key"]] = document.get("content_hash")
+        else:
+            legacy[document["short_text"]["src"]] = document["_id"]
+
+    operations = []
+    for document in batch:
+        key = document["key"]
+        if key in existing:
+            if existing[key] == document["content_hash"]:
+                report["unchanged"] += 1
+                continue
+            selector = {"key": key}
+            report["updated"] += 1
+        elif document["short_text"]["src"] in legacy:
+            # Вопрос загружен в базу до importer.py: получает key, id и ordinal остаются прежними
+            selector = {"_id": legacy.pop(document["short_text"]["src"])}
+            report["updated"] += 1
+        else:
+            selector = {"key": key}
+            report["inserted"] += 1
+        operations.append(UpdateOne(selector, {"$set": document}, upsert=True))
+    if operations and not dry_run:
+        await collection.bulk_write(operations, ordered=False)
+
+
+async def import_catalog(path: str, batch_size: int = 500, dry_run: bool = False,
+                         rejected_path: Optional[str] = None) -> dict:
+    report = {"read": 0, "inserted": 0, "updated": 0, "unchanged": 0, "rejected": 0}
+    started = time.perf_counter()
+    seen = set()
+    batch = []
+    rejected_file = open(rejected_path, "w", encoding="utf-8") if rejected_path else None
+    try:
+        with open(path, encoding="utf-8") as file:
+            for number, entry in enumerate(iter_entries(file), 1):
+                report["read"] += 1
+                try:
+                    document = prepare_question(entry)
+                    if document["key"] in seen:
+                        raise ValueError(f"Duplicate key {document['key']}")
+                except (ValueError, KeyError, TypeError) as error:
+                    report["rejected"] += 1
+                    logging.warning(f"Catalog entry {number} rejected: {describe_error(error)}")
+                    if rejected_file is not None:
+                        rejected_file.write(json.dumps(
+                            {"entry": number, "error": describe_error(error), "value": entry}, ensure_ascii=False
+                        ) + "\n")
+                    continue
+                seen.add(document["key"])
+                batch.append(document)
+                if len(batch) >= batch_size:
+                    await write_batch(batch, report, dry_run)
+                    batch = []
+        await write_batch(batch, report, dry_run)
+    finally:
+        if rejected_file is not None:
+            rejected_file.close()
+
+    if not dry_run and (report["inserted"] or report["updated"]):
+        await models.assign_question_ordinals()
+        # Кэши этого процесса, воркеры приложения перечитают каталог по QUESTION_CACHE_TTL
+        catalog.invalidate()
+        selection.question_ids.invalidate()
+    seconds = time.perf_counter() - started
+    report["seconds"] = round(seconds, 3)
+    report["docs_per_second"] = round(report["read"] / seconds, 1) if seconds else 0.0
+    return report
+
+
+async def main(path: str, batch_size: int, dry_run: bool, rejected_path: Optional[str]):
+    await models.init_database()
+    report = await import_catalog(path, batch_size, dry_run, rejected_path)
+    logging.info(f"Catalog import{' (dry run)' if dry_run else ''}: {report}")
+
+
+if __name__ == "__main__":
+    logger.setup_logging()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("path")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true", help="только проверка и отчёт, без записи")
+    parser.add_argument("--rejected", help="JSON Lines с отклонёнными вопросами и причинами")
+    args = parser.parse_args()
+    asyncio.run(main(args.path, args.batch_size, args.dry_run, args.rejected))
@@ -0,0 +1,136 @@
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+import logging
+import queue
+import copy
+import json
+import zlib
+
+from settings import settings
+
+VERBOSE_FORMAT = u'%(filename)s [LINE:%(lineno)d] #%(levelname)-8s [%(asctime)s]  %(message)s'
+# Поля записи, которые попадают в структурированный лог
+EXTRA_FIELDS = ("event", "command", "tokens", "intents", "fsm_state")
+TRUNCATED_FIELDS = ("tokens", "intents")
+
+current_user: ContextVar[Optional[str]] = ContextVar("current_user", default=None)
+current_handler: ContextVar[Optional[str]] = ContextVar("current_handler", default=None)
+
+_listener: Optional[QueueListener] = None
+
+
+def is_structured() -> bool:
+    return settings.log_mode == "structured"
+
+
+class ContextFilter(logging.Filter):
+    """Добавляет в запись пользователя и обработчик текущего запроса"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.user_id = current_user.get()
+        # log_middleware передаёт обработчик явно: в его контексте current_handler не задан
+        if getattr(record, "handler", None) is None:
+            record.handler = current_handler.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Детерминированная выборка по пользователю: пользователь либо логируется целиком, либо нет.
+    Для обработчиков можно задать свою долю. Предупреждения и ошибки не отбрасываются.
+    """
+
+    def __init__(self, user_rate: float = 1.0, handler_rates: dict[str, float] = None):
+        super().__init__()
+        self.user_rate = user_rate
+        self.handler_rates = handler_rates or {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.handler_rates.get(getattr(record, "handler", None), self.user_rate)
+        if rate >= 1.0:
+            return True
+        user_id = getattr(record, "user_id", None)
+        if user_id is None:
+            return True
+        return zlib.crc32(str(user_id).encode()) / 0xFFFFFFFF < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - один JSON объект в строке"""
+
+    def __init__(self, max_payload: int = 512):
+        super().__init__()
+        self.max_payload = max_payload
+
+    def _truncate(self, value):
+        text = json.dumps(value, ensure_ascii=False)
+        if len(text) <= self.max_payload:
+            return value
+        return text[:self.max_payload] + "..."
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "file": record.filename,
+            "line": record.lineno,
+            "message": record.getMessage(),
+            "user_id": getattr(record, "user_id", None),
+            "handler": getattr(record, "handler", None),
+        }
+        for field in EXTRA_FIELDS:
+            if hasattr(record, field):
+                value = getattr(record, field)
+                data[field] = self._truncate(value) if field in TRUNCATED_FIELDS else value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """Кладёт запись в очередь без форматирования, форматирует фоновый поток"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging():
+    global _listener
+    if not is_structured():
+        logging.basicConfig(format=VERBOSE_FORMAT, level=logging.INFO)
+        return
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter(settings.log_max_payload))
+
+    queue_handler = BackgroundQueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(SamplingFilter(settings.log_sample_rate, settings.log_handler_sample_rates))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(logging.INFO)
+
+    _listener = QueueListener(queue_handler.queue, stream_handler)
+    _listener.start()
+
+
+def after_fork():
+    """Поток записи не переживает fork, в дочернем процессе он запускается заново"""
+    global _listener
+    if _listener is not None:
+        _listener = QueueListener(_listener.queue, *_listener.handlers)
+        _listener.start()
+
+
+async def shutdown_logging(*_):
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,28 +1,70 @@
 import logging
 
-from aioalice import get_new_configured_app
 from aiohttp.web_response import Response
 from aiohttp import web
 
+from question_stats import question_stats
 from settings import settings
+from webhook import get_new_configured_app
 from routes import dp
 import middleware
+import repository
+import progress
+import replay
+import importer
+import catalog
+import executor
+import filters
+import logger
 import models
+import nlu
 
-logging.basicConfig(format=u'%(filename)s [LINE:%(lineno)d] #%(levelname)-8s [%(asctime)s]  %(message)s',
-                    level=logging.INFO)
+logger.setup_logging()
+
+
+async def warm_up_nlu(*_):
+    questions = await repository.repository.all_questions()
+    count = nlu.warm_up((
+        *filters.KEYWORDS,
+        *(answer.text.src for question in questions for answer in question.answers)
+    ))
+    logging.info(f"Lemma cache warmed up with {count} tokens: {nlu.lemma_cache.stats()}")
+
+
+def preload():
+    """Статические данные, которые воркеры gunicorn наследуют от мастера (см. gunicorn.conf.py)"""
+    count = nlu.warm_up(filters.KEYWORDS)
+    if settings.catalog_path:
+        with open(settings.catalog_path, encoding="utf-8") as file:
+            count += nlu.warm_up(
+                answer["text"]["src"] for question in importer.iter_entries(file) for answer in question["answers"]
+            )
+    logging.info(f"Preloaded {count} tokens: {nlu.lemma_cache.stats()}")
 
 
 def prepare_app():
     app = get_new_configured_app(dispatcher=dp, path=settings.path)
     app.router.add_route("*", "/{tail:.*}", lambda _: Response(status=403))
     logging.info("Init database connection")
-    app.on_startup.append(models.init_database)
+    app.on_startup.append(repository.repository.connect)
+    app.on_startup.append(warm_up_nlu)
+    if settings.progress_write_behind:
+        app.on_startup.append(progress.writer.start)
+    app.on_startup.append(question_stats.start)
+    app.on_shutdown.append(progress.writer.shutdown)
+    app.on_shutdown.append(question_stats.shutdown)
+    app.on_shutdown.append(executor.shutdown)
+    app.on_shutdown.append(catalog.log_stats)
+    app.on_shutdown.append(dp.storage.log_stats)
+    app.on_shutdown.append(replay.log_stats)
+    app.on_shutdown.append(repository.log_stats)
+    app.on_shutdown.append(models.log_db_operations)
+    app.on_shutdown.append(logger.shutdown_logging)
     app.middlewares.extend((
-        middleware.only_post_request_middleware,
         middleware.ping_request_middleware,
-        middleware.log_middleware,
-        middleware.session_state_middleware
+        middleware.only_post_request_middleware,
+        middleware.body_middleware,
+        middleware.log_middleware
     ))
     return app
 
@@ -36,5 +78,6 @@ def main():
 if __name__ == '__main__':
     main()
 else:
+    preload()
     app = prepare_app()
 
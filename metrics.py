@@ -0,0 +1,61 @@
+from collections import deque
+
+
+class LatencyStats:
+    """Задержки операции: среднее, максимум и перцентили по последним window замерам"""
+
+    def __init__(self, window: int = 1024):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, elapsed: float):
+        self.count += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.recent.append(elapsed)
+
+    def stats(self) -> dict:
+        recent = sorted(self.recent)
+
+        def at(q: float) -> float:
+            return round(recent[min(len(recent) - 1, int(q * len(recent)))] * 1000, 4) if recent else 0.0
+
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_time / self.count * 1000, 4) if self.count else 0.0,
+            "p50_ms": at(0.5),
+            "p99_ms": at(0.99),
+            "max_ms": round(self.max_time * 1000, 4)
+        }
+
+
+class SizeStats:
+    """Размеры в байтах: среднее, максимум и перцентили по последним window замерам"""
+
+    def __init__(self, window: int = 1024):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, size: int):
+        self.count += 1
+        self.total += size
+        self.max = max(self.max, size)
+        self.recent.append(size)
+
+    def stats(self) -> dict:
+        recent = sorted(self.recent)
+
+        def at(q: float) -> int:
+            return recent[min(len(recent) - 1, int(q * len(recent)))] if recent else 0
+
+        return {
+            "count": self.count,
+            "avg_bytes": round(self.total / self.count, 1) if self.count else 0.0,
+            "p50_bytes": at(0.5),
+            "p99_bytes": at(0.99),
+            "max_bytes": self.max
+        }
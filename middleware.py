@@ -1,11 +1,15 @@
 import logging
-import json
+import re
 
 from aiohttp.web_response import Response
 from aiohttp.web_request import Request
 from aiohttp import web
 
-from state import SessionState
+from context import read_body, get_decode_count, get_handler
+from logger import current_user, is_structured
+
+PING_PATTERN = re.compile(rb'"original_utterance"\s*:\s*"ping"')
+PONG_BODY = b'{"text":"pong"}'
 
 
 @web.middleware
@@ -15,20 +19,48 @@ async def only_post_request_middleware(request: Request, handler):
     return await handler(request)
 
 
+@web.middleware
+async def body_middleware(request: Request, handler):
+    await read_body(request)
+    response = await handler(request)
+    if (decode_count := get_decode_count(request)) > 1:
+        logging.warning(f"Request body decoded {decode_count} times")
+    return response
+
+
 @web.middleware
 async def ping_request_middleware(request: Request, handler):
-    data = await request.json()
-    if data.get("request", {}).get("original_utterance", None) == "ping":
-        return web.json_response({"text": "pong"})
+    # Пинг определяется по сырому телу, без разбора JSON и остальных middleware
+    if request.method.upper() == "POST" and PING_PATTERN.search(await request.read()):
+        return Response(body=PONG_BODY, content_type="application/json")
     return await handler(request)
 
 
 @web.middleware
 async def log_middleware(request: Request, handler):
-    data = await request.json()
+    data = await read_body(request)
     _request = data["request"]
     user_id = data.get('session', {}).get('user_id', 0)
     user_fsm_state = data.get("state", {}).get("session", {}).get("state", None)
+    current_user.set(user_id)
+    if is_structured():
+        # Обработчик известен только после диспетчеризации, а по нему выбирается доля выборки:
+        # пара enter/exit пишется после ответа
+        nlu = _request.get("nlu", {})
+        try:
+            return await handler(request)
+        finally:
+            handler_name = get_handler(request)
+            logging.info("User enter", extra={
+                "event": "enter",
+                "handler": handler_name,
+                "command": _request.get("command", None),
+                "tokens": nlu.get("tokens", None),
+                "intents": nlu.get("intents", None),
+                "fsm_state": user_fsm_state
+            })
+            logging.info("User exit", extra={"event": "exit", "handler": handler_name, "fsm_state": user_fsm_state})
+
     logging.info(
         f"User ({user_id}) enter"
         f"\nCommand: {_request.get('command', None)}"
@@ -43,21 +75,3 @@ async def log_middleware(request: Request, handler):
     )
     return response
 
-
-@web.middleware
-async def session_state_middleware(request, handler):
-    response = await handler(request)
-    data = (await request.json()).get("state", {}).get("session", {})
-    if not data:
-        return response
-
-    state = SessionState.parse_obj(data).dict()
-    body = json.loads(response.body)
-    body_state = body.get("session_state", {})
-    if isinstance(state, dict) and isinstance(body_state, dict):
-        body["session_state"] = state | body.get("session_state", {})
-    else:
-        body["session_state"] = state
-
-    response.body = json.dumps(body)
-    return response
@@ -0,0 +1,97 @@
+"""
+Перенос прогресса пользователей из списка id (UserData.passed_questions) в битовый формат (UserData.passed).
+Запуск: MONGODB_URL=... python migrations.py [--batch-size N] [--dry-run]
+"""
+import argparse
+import asyncio
+import logging
+import time
+
+from pymongo import UpdateOne
+import bson
+
+import logger
+import models
+
+
+def migrated_document(document: dict, words: dict[str, int]) -> dict:
+    """Документ пользователя в новом формате, для отчёта о размере"""
+    migrated = {key: value for key, value in document.items() if key != "passed_questions"}
+    passed = dict(document.get("passed") or {})
+    for key, mask in words.items():
+        passed[key] = passed.get(key, 0) | mask
+    migrated["passed"] = passed
+    return migrated
+
+
+def validate_time(documents: list[dict]) -> float:
+    started = time.perf_counter()
+    for document in documents:
+        models.UserData.model_validate(document)
+    return time.perf_counter() - started
+
+
+async def migrate_passed_questions(batch_size: int = 500, dry_run: bool = False) -> dict:
+    await models.assign_question_ordinals()
+    ordinals = {
+        str(document["_id"]): document["ordinal"]
+        async for document in models.Question.get_motor_collection().find({}, {"ordinal": 1})
+    }
+    collection = models.UserData.get_motor_collection()
+    report = {
+        "users": 0, "dropped_ids": 0,
+        "bytes_before": 0, "bytes_after": 0,
+        "validate_before_ms": 0.0, "validate_after_ms": 0.0
+    }
+    before, after, operations = [], [], []
+
+    async def write():
+        report["validate_before_ms"] += validate_time(before) * 1000
+        report["validate_after_ms"] += validate_time(after) * 1000
+        if operations and not dry_run:
+            await collection.bulk_write(operations, ordered=False)
+        before.clear()
+        after.clear()
+        operations.clear()
+
+    # Новые отметки пишутся только в passed ($bit), поэтому OR со старым списком ничего не теряет
+    async for document in collection.find({"passed_questions.0": {"$exists": True}}):
+        # id удалённых из каталога вопросов отбрасываются
+        known = [ordinals[str(question_id)] for question_id in document["passed_questions"]
+                 if str(question_id) in ordinals]
+        words = models.ordinal_words(known)
+        migrated = migrated_document(document, words)
+        report["users"] += 1
+        report["dropped_ids"] += len(document["passed_questions"]) - len(known)
+        report["bytes_before"] += len(bson.encode(document))
+        report["bytes_after"] += len(bson.encode(migrated))
+        before.append(document)
+        after.append(migrated)
+        update = {"$unset": {"passed_questions": ""}}
+        if words:
+            update["$bit"] = {f"passed.{key}": {"or": mask} for key, mask in words.items()}
+        operations.append(UpdateOne({"_id": document["_id"]}, update))
+        if len(operations) >= batch_size:
+            await write()
+    await write()
+
+    for key in ("validate_before_ms", "validate_after_ms"):
+        report[key] = round(report[key], 2)
+    if report["bytes_before"]:
+        report["bytes_saved"] = f"{1 - report['bytes_after'] / report['bytes_before']:.1%}"
+    return report
+
+
+async def main(batch_size: int, dry_run: bool):
+    await models.init_database()
+    report = await migrate_passed_questions(batch_size, dry_run)
+    logging.info(f"Passed questions migration{' (dry run)' if dry_run else ''}: {report}")
+
+
+if __name__ == "__main__":
+    logger.setup_logging()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true", help="только отчёт, без записи")
+    args = parser.parse_args()
+    asyncio.run(main(args.batch_size, args.dry_run))
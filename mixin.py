@@ -4,8 +4,11 @@ from functools import wraps
 from aioalice.types import AliceRequest, AliceResponse
 from aioalice import Dispatcher
 
+from context import get_body, set_handler
+from logger import current_handler
 from models import RepeatKey
 from state import State
+import replay
 
 
 def mixin_can_repeat(dp: Dispatcher, key: RepeatKey = None):
@@ -14,9 +17,12 @@ def mixin_can_repeat(dp: Dispatcher, key: RepeatKey = None):
         async def wrapper(alice: AliceRequest, *args, **kwargs):
             nonlocal dp, key
             response = await func(alice, *args, **kwargs)
+            if replay.enabled():
+                # Ответ построен заново по session_state, воркер ничего не хранит
+                return response
             data = {"last": response, "last_func": func.__name__}
             if key:
-                data[key] = response
+                data[key.value] = response
 
             await dp.storage.set_data(
                 alice.session.user_id, data
@@ -35,7 +41,7 @@ def mixin_state(func: Callable):
         data = await func(alice, *args, state=state, **kwargs)
         if isinstance(data, dict):
             temp = data.copy()
-            temp.pop("analytics")
+            temp.pop("analytics", None)
             response = AliceResponse(**temp)
         else:
             response = data
@@ -64,8 +70,20 @@ def mixin_appmetrica_log(dp: Dispatcher):
         @wraps(func)
         async def wrapper(alice: AliceRequest, *args, **kwargs):
             nonlocal dp
+            current_handler.set(func.__name__)
+            set_handler(alice, func.__name__)
             state = State.from_request(alice)
             game_state = await dp.storage.get_state(alice.session.user_id, state)
+            # Снимок до вызова: обработчик меняет общий State запроса
+            game = {
+                "current_true_answer": state.session.current_true_answer,
+                "current_question_id": state.session.current_question,
+                "current_answers": state.session.current_answers,
+                "question_passed": state.session.question_passed,
+                "number_of_hints": state.session.number_of_hints,
+                "try_number": state.session.try_number,
+                "score": state.session.score,
+            }
             response: AliceResponse = await func(alice, *args, **kwargs)
             if isinstance(response, AliceResponse):
                 response: dict = response.to_json()
@@ -77,17 +95,9 @@ def mixin_appmetrica_log(dp: Dispatcher):
                             "user": {
                                 "id": alice.session.user_id,
                                 "command": alice.request.command,
-                                "intents": alice.request.nlu._raw_kwargs["intents"]
-                            },
-                            "game": {
-                                "current_true_answer": state.session.current_true_answer,
-                                "current_question_id": state.session.current_question,
-                                "current_answers": state.session.current_answers,
-                                "question_passed": state.session.question_passed,
-                                "number_of_hints": state.session.number_of_hints,
-                                "try_number": state.session.try_number,
-                                "score": state.session.score,
+                                "intents": get_body(alice)["request"]["nlu"]["intents"]
                             },
+                            "game": game,
                             "state": game_state
                         }
                     }
@@ -1,16 +1,23 @@
 from dataclasses import dataclass
-from typing import Optional, Union
+from collections import Counter
+from typing import Optional, Union, Iterable
 from os import getenv
 import asyncio
+import logging
 import enum
 
 from beanie import Document, Indexed, init_beanie, PydanticObjectId
-from pydantic import BaseModel, conlist, model_validator, Field
+from pydantic import BaseModel, conlist, model_validator, create_model, Field
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne, IndexModel
 
 from settings import settings
 
 
+# Запросы к коллекции пользователей по видам, для сравнения числа обращений к базе за ход
+db_operations: Counter = Counter()
+
+
 class RepeatKey(enum.Enum):
     LAST = "last"
     HINT = "hint"
@@ -24,6 +31,16 @@ class CleanAnswer:
     number: int
 
 
+@dataclass(slots=True, frozen=True)
+class AnswerIndex:
+    # Леммы каждого ответа в порядке вариантов, общие для ответов слова и очищенные ответы
+    lemmas: tuple[frozenset[str], ...]
+    common_words: frozenset[str]
+    answers: tuple[CleanAnswer, ...]
+    # Лемма -> маска шаблонов ответов для однопроходного поиска (nlu.compile_patterns)
+    patterns: dict[str, int]
+
+
 @dataclass(slots=True, frozen=True)
 class Diff:
     answer: str
@@ -57,32 +74,128 @@ class Answer(BaseModel):
     text: Text
     description: Text
     is_true: bool = False
+    # Леммы text.src, заполняются при импорте каталога (importer.py)
+    lemmas: list[str] = Field(default_factory=list)
+
+
+# Счётчики QuestionStatistic
+STATISTIC_COUNTERS = ("shown", "correct", "wrong", "skipped", "hinted")
 
 
 class QuestionStatistic(Document):
+    """Счётчики по вопросу, пишутся пачками $inc из question_stats.py"""
     question_id: Indexed(str, unique=True)
+    # Вопрос задан, верные и неверные попытки, пропуски, взятые подсказки
+    shown: int = 0
+    correct: int = 0
+    wrong: int = 0
+    skipped: int = 0
+    hinted: int = 0
+
+    class Settings:
+        name = "QuestionStatistics"
+
+
+# Бит вопроса в слове прогресса: 63 бита, чтобы слово оставалось положительным int64
+WORD_BITS = 63
+
+
+def ordinal_words(ordinals: Iterable[int]) -> dict[str, int]:
+    """Порядковые номера вопросов -> {номер слова: маска}"""
+    words = {}
+    for ordinal in ordinals:
+        key = str(ordinal // WORD_BITS)
+        words[key] = words.get(key, 0) | 1 << (ordinal % WORD_BITS)
+    return words
 
 
 class UserData(Document):
     user_id: Indexed(str, unique=True)
+    # Пройденные вопросы: бит ordinal % WORD_BITS в слове ordinal // WORD_BITS (Question.ordinal)
+    passed: dict[str, int] = Field(default_factory=dict)
+    # Прежний формат, переносится в passed скриптом migrations.py
     passed_questions: list[PydanticObjectId] = Field(default_factory=list)
+    # Порядок выдачи вопросов: перестановка каталога по seed и позиция в ней (см. selection.py)
+    selection_seed: Optional[int] = None
+    selection_cursor: int = 0
+    selection_size: int = 0
+    # Круг по перестановке ещё сверяется с пройденными вопросами (selection.next_question_id).
+    # True по умолчанию: у документов, записанных до появления поля, текущий круг проверяется до конца
+    selection_verify: bool = True
+
+    def has_passed(self, ordinal: int) -> bool:
+        return bool(self.passed.get(str(ordinal // WORD_BITS), 0) >> (ordinal % WORD_BITS) & 1)
+
+    def passed_ordinals(self) -> set[int]:
+        result = set()
+        for key, word in self.passed.items():
+            base = int(key) * WORD_BITS
+            while word:
+                bit = word & -word
+                result.add(base + bit.bit_length() - 1)
+                word ^= bit
+        return result
+
+    def unseen(self, ordinals: Iterable[int]) -> list[int]:
+        return [ordinal for ordinal in ordinals if not self.has_passed(ordinal)]
+
+    def mark_passed(self, ordinals: Iterable[int]):
+        for key, mask in ordinal_words(ordinals).items():
+            self.passed[key] = self.passed.get(key, 0) | mask
 
     @classmethod
     async def get_user_data(cls, user_id: str) -> "UserData":
-        user_data = await cls.find_one({"user_id": user_id})
+        """Один запрос: читает пользователя, а нового создаёт (upsert)"""
+        db_operations["get_user_data"] += 1
+        data = await cls.get_motor_collection().find_one_and_update(
+            {"user_id": user_id},
+            {"$setOnInsert": {"passed": {}}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return cls.model_validate(data)
 
-        if user_data is None:
-            user_data = UserData(user_id=user_id)
-            await user_data.save()
+    @classmethod
+    async def record_question(cls, user_id: str, ordinal: int, **fields):
+        """
+        Один запрос: отмечает вопрос пройденным ($bit, документ не перезаписывается)
+        и обновляет поля fields. Пользователь создаётся, если его ещё нет
+        """
+        db_operations["record_question"] += 1
+        update = cls.progress_update(user_id, (ordinal,), **fields)
+        await cls.get_motor_collection().update_one(update["filter"], update["update"], upsert=True)
 
-        return user_data
+    @classmethod
+    async def reset_progress(cls, user_id: str, **fields):
+        """Все вопросы пройдены: очищает пройденные и обновляет поля fields"""
+        db_operations["reset_progress"] += 1
+        update = cls.progress_update(user_id, reset=True, **fields)
+        await cls.get_motor_collection().update_one(update["filter"], update["update"], upsert=True)
+
+    @staticmethod
+    def progress_update(user_id: str, added: Iterable[int] = (), reset: bool = False, **fields) -> dict:
+        """Фильтр и обновление прогресса пользователя, для update_one и bulk_progress_update"""
+        words = ordinal_words(added)
+        if reset:
+            update = {"$set": {"passed": words, **fields}, "$unset": {"passed_questions": ""}}
+        else:
+            update = {}
+            if words:
+                update["$bit"] = {f"passed.{key}": {"or": mask} for key, mask in words.items()}
+            if fields:
+                update["$set"] = fields
+        return {"filter": {"user_id": user_id}, "update": update or {"$setOnInsert": {"passed": {}}}}
+
+    @classmethod
+    async def bulk_progress_update(cls, updates: list[dict]):
+        db_operations["bulk_progress_update"] += 1
+        await cls.get_motor_collection().bulk_write(
+            [UpdateOne(update["filter"], update["update"], upsert=True) for update in updates], ordered=False
+        )
 
-    async def add_passed_question(self, question_id: Union[str, PydanticObjectId]):
-        if question_id not in self.passed_questions:
-            if isinstance(question_id, str):
-                question_id = PydanticObjectId(question_id)
-            self.passed_questions.append(question_id)
-            await self.save()
+    async def add_passed_question(self, ordinal: int):
+        await self.record_question(self.user_id, ordinal)
+        self.mark_passed((ordinal,))
 
 """
 user_id
@@ -92,20 +205,78 @@ user_id
 
 # Модель из БД
 class Question(Document):
+    # Постоянный небольшой номер вопроса для хранения прогресса битами (UserData.passed)
+    ordinal: Optional[int] = None
+    # Ключ вопроса в файле каталога и хэш содержимого: повторный импорт обновляет только изменённые
+    key: Optional[str] = None
+    content_hash: Optional[str] = None
     full_text: Text
     short_text: Text
     hint: Text
+    difficulty: Optional[str] = None
     answers: conlist(Answer, max_length=3)
     image: Optional[Image]
     fact: Text
+    # Общие для вариантов ответа леммы (nlu.find_common_lemmas), заполняются при импорте
+    common_words: list[str] = Field(default_factory=list)
 
     class Settings:
         name = "Questions"
+        # Indexed внутри Optional beanie не видит, поэтому индекс объявлен явно.
+        # Частичный: вопросы, загруженные до importer.py, ещё без key
+        indexes = [
+            IndexModel("key", name="key_1", unique=True, partialFilterExpression={"key": {"$type": "string"}})
+        ]
+
+
+async def assign_question_ordinals(*_) -> int:
+    """
+    Выдаёт номера вопросам без ordinal. Номер берётся из счётчика в базе,
+    поэтому одновременный запуск в нескольких воркерах не выдаст один номер дважды
+    """
+    collection = Question.get_motor_collection()
+    counters = collection.database["Counters"]
+    assigned = 0
+    async for document in collection.find({"ordinal": None}, {"_id": 1}).sort("_id"):
+        counter = await counters.find_one_and_update(
+            {"_id": "question_ordinal"}, {"$inc": {"value": 1}},
+            upsert=True, return_document=ReturnDocument.AFTER
+        )
+        result = await collection.update_one(
+            {"_id": document["_id"], "ordinal": None}, {"$set": {"ordinal": counter["value"] - 1}}
+        )
+        assigned += result.modified_count
+    if assigned:
+        logging.info(f"Assigned ordinals to {assigned} questions")
+    return assigned
+
+
+# Класс документа -> модель pydantic с теми же полями, для build_document
+_document_fields: dict[type, type[BaseModel]] = {}
+
+
+def build_document(document_class: type[Document], data: dict) -> Document:
+    """
+    Документ без подключения к базе (repository.MemoryRepository): model_validate у beanie
+    требует init_beanie, поэтому поля проверяются отдельной моделью
+    """
+    fields = _document_fields.get(document_class)
+    if fields is None:
+        fields = _document_fields[document_class] = create_model(
+            f"{document_class.__name__}Fields",
+            **{name: (field.annotation, field) for name, field in document_class.model_fields.items()
+               if name != "revision_id"}
+        )
+    return document_class.model_construct(**dict(fields.model_validate(data)))
+
+
+async def log_db_operations(*_):
+    logging.info(f"User data operations: {dict(db_operations)}")
 
 
 async def init_database(*_):
     client = AsyncIOMotorClient(settings.mongodb_url)
-    await init_beanie(database=client["QUEST"], document_models=[Question, UserData])
+    await init_beanie(database=client["QUEST"], document_models=[Question, UserData, QuestionStatistic])
 
 
 # This is an asynchronous example, so we will access it from an async function
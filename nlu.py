@@ -1,19 +1,51 @@
-from functools import lru_cache
+from functools import lru_cache, cached_property
 from operator import attrgetter
-from typing import Union
+from typing import Optional, Union, Iterable
 import logging
+import time
 
 from aioalice.types import AliceRequest
 import pymorphy2
 
-from models import Diff, UserCheck, CleanAnswer
-from state import State
+from models import Diff, UserCheck, CleanAnswer, AnswerIndex
+from context import get_body
+from settings import settings
+from cache import LRUCache
+from state import State, SessionState
+from fuzzy import NgramIndex
+import fuzzy
 
 morph = pymorphy2.MorphAnalyzer()
+# token -> первый разбор pymorphy2
+lemma_cache = LRUCache(settings.lemma_cache_size, settings.lemma_cache_eviction)
+# (question_id, тексты ответов в порядке вариантов) -> AnswerIndex
+answer_index_cache = LRUCache(settings.answer_index_cache_size)
+# тот же ключ -> n-граммный индекс слов ответов для нечёткой стадии
+fuzzy_index_cache = LRUCache(settings.answer_index_cache_size)
+
+NEGATIONS = ("не", "ни")
+
+
+def parse_word(token: str) -> pymorphy2.analyzer.Parse:
+    parsed = lemma_cache.get(token)
+    if parsed is None:
+        parsed = morph.parse(token)[0]
+        lemma_cache.set(token, parsed)
+    return parsed
 
 
 def lemmatize(tokens: list[str]) -> list[str]:
-    return [morph.parse(token)[0].normal_form for token in tokens]
+    return [parse_word(token).normal_form for token in tokens]
+
+
+def warm_up(texts: Iterable[str]) -> int:
+    """Заполняет кэш лемм словами из текстов, возвращает число разобранных токенов"""
+    count = 0
+    for text in texts:
+        for token in tokenizer(text):
+            parse_word(token)
+            count += 1
+    return count
 
 
 def tokenizer(text: str) -> list[str]:
@@ -21,6 +53,40 @@ def tokenizer(text: str) -> list[str]:
     return text.split()
 
 
+class Analysis:
+    """Разбор команды пользователя, общий для всех фильтров и обработчиков одного запроса"""
+
+    def __init__(self, command: str, intents: dict):
+        self.command = command or ""
+        self._intents = intents
+
+    @cached_property
+    def tokens(self) -> list[str]:
+        return tokenizer(self.command)
+
+    @cached_property
+    def lemmas(self) -> list[str]:
+        return lemmatize(self.tokens)
+
+    @cached_property
+    def lemma_set(self) -> set[str]:
+        return set(self.lemmas)
+
+    @cached_property
+    def intents(self) -> set[str]:
+        return set(self._intents.keys())
+
+
+def analyze(alice: AliceRequest) -> Analysis:
+    """Разбор команды считается лениво и один раз на запрос"""
+    analysis = alice.__dict__.get("_nlu_analysis", None)
+    if analysis is None:
+        intents = get_body(alice)["request"].get("nlu", {}).get("intents", {})
+        analysis = Analysis(alice.request.command, intents)
+        alice.__dict__["_nlu_analysis"] = analysis
+    return analysis
+
+
 def calculate_coincidence(
         input_tokens: Union[set[str], list[str]],
         source_tokens: Union[set[str], list[str]]) -> float:
@@ -51,7 +117,7 @@ def find_occurrences(words: list[str], find_words: list[str], skip_index: set[in
 def exclude_words(words: list[str], enters: set[int]) -> bool:
     for number in enters:
         if number >= 1 and number != len(words):
-            if words[number - 1] in ("не", "ни"):
+            if words[number - 1] in NEGATIONS:
                 break
     else:
         return False
@@ -59,7 +125,10 @@ def exclude_words(words: list[str], enters: set[int]) -> bool:
 
 
 def find_common_words(tokens: list[str]) -> set[str]:
-    tokens = [set(lemmatize(tokenizer(token))) for token in tokens]
+    return find_common_lemmas([set(lemmatize(tokenizer(token))) for token in tokens])
+
+
+def find_common_lemmas(tokens: list[set[str]]) -> set[str]:
     result = set()
     tokens_len = len(tokens)
     for i in range(tokens_len):
@@ -78,19 +147,77 @@ def remove_common_words(text_tokens: list[str], words: set[str]) -> list[str]:
 
 
 def remove_common_words_from_answers(answers: list[tuple[int, str]]) -> list[CleanAnswer]:
-    common_answers_words = find_common_words([value[1] for value in answers])
-    result = []
-    for answer in answers:
-        result.append(
-            CleanAnswer(
-                number=answer[0],
-                src=answer[1],
-                clean=remove_common_words(
-                    lemmatize(tokenizer(answer[1])), common_answers_words
-                )
-            )
+    return list(build_answer_index(answers).answers)
+
+
+def build_answer_index(answers: list[tuple[int, str]], lemmas: Optional[list[list[str]]] = None,
+                       common_words: Optional[Iterable[str]] = None) -> AnswerIndex:
+    """lemmas и common_words - посчитанные при импорте каталога значения (Answer.lemmas, Question.common_words)"""
+    if lemmas is None:
+        lemmas = [lemmatize(tokenizer(answer[1])) for answer in answers]
+    if common_words is None:
+        common_answers_words = find_common_lemmas([set(value) for value in lemmas])
+    else:
+        common_answers_words = set(common_words)
+    clean_answers = tuple(
+        CleanAnswer(
+            number=answer[0],
+            src=answer[1],
+            clean=remove_common_words(value, common_answers_words)
         )
-    return result
+        for answer, value in zip(answers, lemmas)
+    )
+    return AnswerIndex(
+        lemmas=tuple(frozenset(value) for value in lemmas),
+        common_words=frozenset(common_answers_words),
+        answers=clean_answers,
+        patterns=compile_patterns(list(clean_answers))
+    )
+
+
+def get_answer_index(question_id: str, answers: list[tuple[int, str]], lemmas: Optional[list[list[str]]] = None,
+                     common_words: Optional[Iterable[str]] = None) -> AnswerIndex:
+    """Индекс ответов вопроса, строится один раз на вопрос и порядок вариантов"""
+    key = (question_id, tuple(answer[1] for answer in answers))
+    index = answer_index_cache.get(key)
+    if index is None:
+        index = build_answer_index(answers, lemmas, common_words)
+        answer_index_cache.set(key, index)
+    return index
+
+
+def get_fuzzy_index(question_id: str, index: AnswerIndex) -> NgramIndex:
+    key = (question_id, tuple(answer.src for answer in index.answers))
+    ngram_index = fuzzy_index_cache.get(key)
+    if ngram_index is None:
+        ngram_index = NgramIndex(word for answer in index.answers for word in answer.clean if word != "*")
+        fuzzy_index_cache.set(key, ngram_index)
+    return ngram_index
+
+
+def calculate_correct_answer_by_fuzzy(
+        user_answer: str, answers: list[CleanAnswer], ngram_index: NgramIndex,
+        threshold: float = 0.33) -> list[Diff]:
+    """
+    Заменяет слова фразы на близкие по написанию слова ответов ("матилец" -> "мальтиец")
+    и повторяет сравнение по тексту. Слова после отрицания не исправляются
+    """
+    started = time.perf_counter()
+    tokens = lemmatize(tokenizer(user_answer))
+    corrected = False
+    for i, token in enumerate(tokens):
+        if token in ngram_index.words or len(token) < settings.fuzzy_min_length \
+                or (i > 0 and tokens[i - 1] in NEGATIONS):
+            continue
+        match = ngram_index.match(token, settings.fuzzy_threshold, settings.fuzzy_candidates)
+        if match is not None:
+            logging.info(f"Fuzzy match: {token} -> {match[0]} ({match[1]:.2f})")
+            tokens[i] = match[0]
+            corrected = True
+
+    diffs = calculate_correct_answer_by_text(" ".join(tokens), answers, threshold) if corrected else []
+    fuzzy.stats.observe(time.perf_counter() - started, corrected, bool(diffs))
+    return diffs
 
 
 def calculate_correct_answer_by_number(
@@ -131,17 +258,76 @@ def calculate_correct_answer_by_text(
     return result
 
 
-def clean_user_command(command: str, answers: list[CleanAnswer]) -> str:
-    user_answer_tokens = lemmatize(tokenizer(command))
-    common_answers_words = find_common_words([answer.src for answer in answers])
-    result = remove_common_words(user_answer_tokens, common_answers_words)
-
-    skip_index = set()
-    text_enters = []
-    for answer in answers:
-        indexs = find_occurrences(result, answer.clean, skip_index)
-        text_enters.append(indexs)
-        skip_index.symmetric_difference_update(indexs)
+def _prepare_user_command(
+        command: Union[str, list[str]], answers: list[CleanAnswer], common_answers_words: set[str] = None) -> list[str]:
+    # command - текст команды или уже лемматизированные токены
+    if isinstance(command, str):
+        user_answer_tokens = lemmatize(tokenizer(command))
+    else:
+        user_answer_tokens = command
+    if common_answers_words is None:
+        common_answers_words = find_common_words([answer.src for answer in answers])
+    return remove_common_words(user_answer_tokens, common_answers_words)
+
+
+def compile_patterns(answers: list[CleanAnswer]) -> dict[str, int]:
+    """
+    Лемма -> битовая маска шаблонов, в которые она входит.
+    Шаблон 2 * i - слова i-го ответа, 2 * i + 1 - его номер
+    """
+    patterns = {}
+    for i, answer in enumerate(answers):
+        for word in answer.clean:
+            patterns[word] = patterns.get(word, 0) | 1 << (2 * i)
+        number = str(answer.number)
+        patterns[number] = patterns.get(number, 0) | 1 << (2 * i + 1)
+    return patterns
+
+
+def clean_user_command(
+        command: Union[str, list[str]], answers: list[CleanAnswer],
+        common_answers_words: set[str] = None, patterns: dict[str, int] = None) -> str:
+    """Заменяет на "*" упоминания ответов и их номеров, перед которыми стоит отрицание"""
+    result = _prepare_user_command(command, answers, common_answers_words)
+    if patterns is None:
+        patterns = compile_patterns(answers)
+
+    # Один проход по фразе: позиции всех шаблонов и отрицания перед словами
+    positions = [[] for _ in range(2 * len(answers))]
+    negated = []
+    previous = None
+    for i, word in enumerate(result):
+        negated.append(previous in NEGATIONS)
+        previous = word
+        mask = patterns.get(word, 0)
+        while mask:
+            bit = mask & -mask
+            positions[bit.bit_length() - 1].append(i)
+            mask ^= bit
+
+    # Шаблоны применяются по порядку, как в clean_user_command_scan:
+    # учитывается первое вхождение и следующее сразу за ним слово
+    masked = set()
+    # Замаскированное слово становится "*" и может совпасть с шаблоном, содержащим "*"
+    star = patterns.get("*", 0)
+    for pattern, found in enumerate(positions):
+        if masked:
+            found = [i for i in found if i not in masked]
+            if star >> pattern & 1:
+                found = sorted({*found, *masked})
+        if not found:
+            continue
+        enters = found[:2] if len(found) > 1 and found[1] == found[0] + 1 else found[:1]
+        if any(negated[i] and i - 1 not in masked for i in enters):
+            masked.update(enters)
+
+    return " ".join("*" if i in masked else word for i, word in enumerate(result))
+
+
+def clean_user_command_scan(
+        command: Union[str, list[str]], answers: list[CleanAnswer], common_answers_words: set[str] = None) -> str:
+    """Исходная реализация clean_user_command на find_occurrences, эталон для сравнения и бенчмарка"""
+    result = _prepare_user_command(command, answers, common_answers_words)
 
     for answer in answers:
         text_enters = find_occurrences(result, answer.clean)
@@ -176,16 +362,27 @@ def check_user_answer(alice: AliceRequest) -> Union[UserCheck, list[Diff]]:
         else:
             return UserCheck()
 
-    answers = remove_common_words_from_answers(state.session.current_answers)
-    user_answer = clean_user_command(alice.request.command, answers)
+    return check_answer_by_lemmas(state.session, analyze(alice).lemmas)
+
+
+def check_answer_by_lemmas(session: SessionState, lemmas: list[str], index: Optional[AnswerIndex] = None,
+                           ngram_index: Optional[NgramIndex] = None) -> Union[UserCheck, list[Diff]]:
+    """
+    Проверка ответа по леммам команды. Принимает и возвращает только данные, поэтому может выполняться в пуле.
+    index и ngram_index - уже построенные индексы ответов, иначе берутся из кэшей этого процесса
+    """
+    if index is None:
+        index = get_answer_index(session.current_question, session.current_answers)
+    answers = list(index.answers)
+    user_answer = clean_user_command(lemmas, answers, index.common_words, index.patterns)
     diffs = calculate_correct_answer_by_text(
         user_answer, answers
     )
-    logging.info(f"Answer by text: {diffs};\nAnswers: {state.session.current_answers} \nClean answers: {answers}")
+    logging.info(f"Answer by text: {diffs};\nAnswers: {session.current_answers} \nClean answers: {answers}")
     if len(diffs) == 1:
         diff = diffs[0]
         return UserCheck(
-            is_true_answer=state.session.current_true_answer == diff.number,
+            is_true_answer=session.current_true_answer == diff.number,
             diff=diff
         )
     elif len(diffs) > 1:
@@ -194,23 +391,37 @@ def check_user_answer(alice: AliceRequest) -> Union[UserCheck, list[Diff]]:
     diffs = calculate_correct_answer_by_number(
         user_answer, answers
     )
-    logging.info(f"Answer by number: {diffs};\nAnswers: {state.session.current_answers} \nClean answers: {answers}")
+    logging.info(f"Answer by number: {diffs};\nAnswers: {session.current_answers} \nClean answers: {answers}")
     if len(diffs) == 1:
         diff = diffs[0]
         return UserCheck(
-            is_true_answer=state.session.current_true_answer == diff.number,
+            is_true_answer=session.current_true_answer == diff.number,
             diff=diff
         )
     elif len(diffs) > 1:
         return diffs
 
+    if settings.fuzzy_matching:
+        if ngram_index is None:
+            ngram_index = get_fuzzy_index(session.current_question, index)
+        diffs = calculate_correct_answer_by_fuzzy(user_answer, answers, ngram_index)
+        logging.info(f"Answer by fuzzy text: {diffs};\nFuzzy stats: {fuzzy.stats.stats()}")
+        if len(diffs) == 1:
+            diff = diffs[0]
+            return UserCheck(
+                is_true_answer=session.current_true_answer == diff.number,
+                diff=diff
+            )
+        elif len(diffs) > 1:
+            return diffs
+
     return UserCheck()
 
 
 
 @lru_cache()
 def declension_of_word_after_numeral(word: str, number: int) -> str:
-    word = morph.parse(word)[0]
+    word = parse_word(word)
     return word.make_agree_with_number(number).word
 
 
@@ -240,3 +451,29 @@ if __name__ == '__main__':
     print("Clean user answer", clean_user_answer)
     print("Clean answers", clean_answers)
     print(round(time.perf_counter() - start, 3))
+    print()
+
+    import timeit
+
+    examples = (
+        ("думаю это рыцари матильцы", [
+            "Рыцари-тевроны и рыцари-матильцы", "Мусульманские воины и крестоносцы из Европы",
+            "Рыцари-тамплиеры и рыцари-оспиталиеры"]),
+        ("это точно не битва при бородино это битва при ватерлоо или аустерлице", [
+            "битва при аустерлице", "битва при бородино", "битва при ватерлоо"]),
+    )
+    # Длинная фраза: стоимость сканирования растёт как ответы x слова x длина ответа
+    examples += ((" ".join([examples[1][0]] * 8), examples[1][1]),)
+    for user_answer, answers in examples:
+        index = build_answer_index([(i, answer) for i, answer in enumerate(answers, 1)])
+        clean_answers = list(index.answers)
+        user_tokens = lemmatize(tokenizer(user_answer))
+        assert clean_user_command(user_tokens, clean_answers, index.common_words, index.patterns) == \
+               clean_user_command_scan(user_tokens, clean_answers, index.common_words)
+        scan = min(timeit.repeat(
+            lambda: clean_user_command_scan(user_tokens, clean_answers, index.common_words),
+            number=10000, repeat=5))
+        matcher = min(timeit.repeat(
+            lambda: clean_user_command(user_tokens, clean_answers, index.common_words, index.patterns),
+            number=10000, repeat=5))
+        print(f"{user_answer[:70]!r}: scan {scan * 100:.2f} us, matcher {matcher * 100:.2f} us")
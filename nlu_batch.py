@@ -0,0 +1,106 @@
+# Пакетная оценка ответов для офлайн-переразметки логов и подбора порога.
+# Результаты совпадают с calculate_correct_answer_by_text/by_number после clean_user_command.
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from operator import attrgetter
+from typing import Iterable, Sequence
+
+from models import Diff, CleanAnswer
+import nlu
+
+Answers = Sequence[tuple[int, str]]
+
+
+@dataclass(slots=True, frozen=True)
+class BatchResult:
+    by_text: list[Diff]
+    by_number: list[Diff]
+
+
+class Vocabulary:
+    """Словарь партии: каждый уникальный токен лемматизируется один раз, лемма получает номер бита"""
+
+    def __init__(self):
+        self.lemmas: dict[str, str] = {}
+        self.bits: dict[str, int] = {}
+
+    def lemmatize(self, tokens: list[str]) -> list[str]:
+        result = []
+        for token in tokens:
+            lemma = self.lemmas.get(token)
+            if lemma is None:
+                lemma = self.lemmas[token] = nlu.parse_word(token).normal_form
+            result.append(lemma)
+        return result
+
+    def mask(self, words: Iterable[str]) -> int:
+        result = 0
+        for word in words:
+            bit = self.bits.get(word)
+            if bit is None:
+                bit = self.bits[word] = len(self.bits)
+            result |= 1 << bit
+        return result
+
+
+def _score(user_mask: int, answers: Sequence[CleanAnswer], masks: Sequence[int], threshold: float) -> list[Diff]:
+    result = []
+    for answer, mask in zip(answers, masks):
+        coincidence = (user_mask & mask).bit_count() / mask.bit_count()
+        if coincidence >= threshold:
+            result.append(Diff(answer=answer.src, number=answer.number, coincidence=coincidence))
+    result.sort(key=attrgetter("coincidence"), reverse=True)
+    return result
+
+
+def _score_chunk(pairs: list[tuple[str, Answers]], threshold: float) -> list[BatchResult]:
+    vocabulary = Vocabulary()
+    # Ответы вопроса повторяются по всей партии, поэтому индекс и маски строятся один раз
+    compiled = {}
+    results = []
+    for utterance, answers in pairs:
+        key = tuple((answer[0], answer[1]) for answer in answers)
+        if key not in compiled:
+            lemmas = [vocabulary.lemmatize(nlu.tokenizer(answer[1])) for answer in key]
+            common_words = nlu.find_common_lemmas([set(value) for value in lemmas])
+            clean_answers = [
+                CleanAnswer(src=answer[1], number=answer[0], clean=nlu.remove_common_words(value, common_words))
+                for answer, value in zip(key, lemmas)
+            ]
+            compiled[key] = (
+                clean_answers,
+                common_words,
+                nlu.compile_patterns(clean_answers),
+                [vocabulary.mask(answer.clean) for answer in clean_answers],
+                [vocabulary.mask(str(answer.number)) for answer in clean_answers]
+            )
+        clean_answers, common_words, patterns, text_masks, number_masks = compiled[key]
+
+        user_answer = nlu.clean_user_command(
+            vocabulary.lemmatize(nlu.tokenizer(utterance)), clean_answers, common_words, patterns
+        )
+        user_mask = vocabulary.mask(vocabulary.lemmatize(nlu.tokenizer(user_answer)))
+        results.append(BatchResult(
+            by_text=_score(user_mask, clean_answers, text_masks, threshold),
+            by_number=_score(user_mask, clean_answers, number_masks, threshold)
+        ))
+    return results
+
+
+def score_batch(
+        pairs: Iterable[tuple[str, Answers]], threshold: float = 0.33,
+        workers: int = 1, chunk_size: int = 10000) -> list[BatchResult]:
+    """
+    Оценивает пары (фраза пользователя, варианты ответов [(номер, текст), ...]).
+    workers > 1 - партия делится на части по chunk_size и считается в пуле процессов.
+    """
+    pairs = list(pairs)
+    if workers <= 1 or len(pairs) <= chunk_size:
+        return _score_chunk(pairs, threshold)
+
+    chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk_result in executor.map(_score_chunk, chunks, [threshold] * len(chunks)):
+            results.extend(chunk_result)
+    return results
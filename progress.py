@@ -0,0 +1,166 @@
+from dataclasses import dataclass, field
+from typing import Optional
+import asyncio
+import logging
+import time
+
+from repository import repository
+from metrics import LatencyStats
+from settings import settings
+import models
+
+
+@dataclass(slots=True)
+class ProgressUpdate:
+    """Ещё не записанные изменения прогресса одного пользователя"""
+    # Порядковые номера пройденных вопросов (Question.ordinal)
+    added: set[int] = field(default_factory=set)
+    fields: dict = field(default_factory=dict)
+    # Пройденные очищены: после записи в базе останутся только added
+    reset: bool = False
+
+    def merge(self, newer: "ProgressUpdate"):
+        if newer.reset:
+            self.added = set(newer.added)
+            self.reset = True
+        else:
+            self.added.update(newer.added)
+        self.fields.update(newer.fields)
+
+    def apply(self, user_data: models.UserData):
+        """Накладывает изменения на прочитанный из базы документ"""
+        if self.reset:
+            user_data.passed = {}
+            user_data.passed_questions = []
+        user_data.mark_passed(self.added)
+        for name, value in self.fields.items():
+            setattr(user_data, name, value)
+
+    def to_operation(self, user_id: str):
+        return models.UserData.progress_update(user_id, self.added, self.reset, **self.fields)
+
+
+class ProgressWriter:
+    """
+    Отложенная запись прогресса пользователей (write-behind).
+    Обработчик ставит изменение в очередь и сразу отвечает, фоновая задача объединяет изменения
+    по пользователю и пишет их одним bulk_write по размеру очереди или по таймеру.
+    Прочитанный через get_user_data документ уже содержит незаписанные изменения этого процесса
+    """
+
+    def __init__(self, flush_size: int = 100, flush_interval: float = 1.0):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.pending: dict[str, ProgressUpdate] = {}
+        # Изменения, которые сейчас пишутся в базу
+        self.inflight: dict[str, ProgressUpdate] = {}
+        self.enqueued = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.last_flush_size = 0
+        self.max_flush_size = 0
+        self.flushed_users = 0
+        self.flush_latency = LatencyStats()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    def _enqueue(self, user_id: str, update: ProgressUpdate):
+        self.enqueued += 1
+        if user_id in self.pending:
+            self.pending[user_id].merge(update)
+        else:
+            self.pending[user_id] = update
+        if len(self.pending) >= self.flush_size:
+            self._wakeup.set()
+
+    async def record_question(self, user_id: str, ordinal: int, **fields):
+        if self._task is None:
+            return await repository.record_question(user_id, ordinal, **fields)
+        self._enqueue(user_id, ProgressUpdate(added={ordinal}, fields=fields))
+
+    async def reset_progress(self, user_id: str, **fields):
+        if self._task is None:
+            return await repository.reset_progress(user_id, **fields)
+        self._enqueue(user_id, ProgressUpdate(fields=fields, reset=True))
+
+    def _updates(self, user_id: str) -> list[ProgressUpdate]:
+        return [updates[user_id] for updates in (self.inflight, self.pending) if user_id in updates]
+
+    async def get_user_data(self, user_id: str) -> models.UserData:
+        # Изменения, записанные во время чтения, могут не попасть в документ: накладываются
+        # и те, что были в очереди до чтения, и те, что есть после (apply идемпотентен)
+        before = self._updates(user_id)
+        user_data = await repository.get_user_data(user_id)
+        after = [update for update in self._updates(user_id) if all(update is not value for value in before)]
+        for update in (*before, *after):
+            update.apply(user_data)
+        return user_data
+
+    async def flush(self):
+        async with self._lock:
+            if not self.pending:
+                return
+            self.inflight, self.pending = self.pending, {}
+            started = time.perf_counter()
+            try:
+                await repository.bulk_progress_update(self.inflight)
+            except Exception:
+                self.failed_flushes += 1
+                logging.exception(f"Progress flush of {len(self.inflight)} users failed, will retry")
+                # Неудачная партия старше новых изменений, они накладываются поверх
+                for user_id, update in self.pending.items():
+                    if user_id in self.inflight:
+                        self.inflight[user_id].merge(update)
+                    else:
+                        self.inflight[user_id] = update
+                self.pending, self.inflight = self.inflight, {}
+                return
+            finally:
+                self.flush_latency.observe(time.perf_counter() - started)
+            self.flushes += 1
+            self.last_flush_size = len(self.inflight)
+            self.max_flush_size = max(self.max_flush_size, self.last_flush_size)
+            self.flushed_users += self.last_flush_size
+            self.inflight = {}
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def start(self, *_):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.ensure_future(self._run())
+
+    async def shutdown(self, *_):
+        """Останавливает фоновую задачу и записывает всё, что осталось в очереди"""
+        if self._task is not None:
+            # Без отмены: запись, которая уже идёт, должна завершиться
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        logging.info(f"Progress writer: {self.stats()}")
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self.pending),
+            "enqueued": self.enqueued,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "last_flush_size": self.last_flush_size,
+            "max_flush_size": self.max_flush_size,
+            "avg_flush_size": round(self.flushed_users / self.flushes, 2) if self.flushes else 0.0,
+            "flush": self.flush_latency.stats()
+        }
+
+
+writer = ProgressWriter(settings.progress_flush_size, settings.progress_flush_interval)
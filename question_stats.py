@@ -0,0 +1,117 @@
+"""
+Счётчики по вопросам (models.QuestionStatistic): обработчики прибавляют их в памяти,
+фоновая задача пишет накопленное пачкой $inc-upsert раз в QUESTION_STATS_FLUSH_INTERVAL секунд.
+Отчёт: MONGODB_URL=... python question_stats.py
+"""
+from collections import Counter
+from typing import Optional
+import asyncio
+import logging
+import json
+
+from repository import repository
+from settings import settings
+import logger
+import models
+
+
+class QuestionStats:
+    def __init__(self, flush_interval: float = 5.0):
+        self.flush_interval = flush_interval
+        self.pending: dict[str, Counter] = {}
+        self.recorded = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    def record(self, question_id: Optional[str], counter: str):
+        """Без ожидания базы: только прибавка в памяти"""
+        if not question_id:
+            return
+        if counter not in models.STATISTIC_COUNTERS:
+            raise ValueError(f"Unknown question counter {counter!r}")
+        self.recorded += 1
+        self.pending.setdefault(question_id, Counter())[counter] += 1
+
+    async def flush(self):
+        async with self._lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, {}
+            try:
+                await repository.increment_statistics(batch)
+            except Exception:
+                self.failed_flushes += 1
+                logging.exception(f"Question statistics flush of {len(batch)} questions failed, will retry")
+                for question_id, counter in batch.items():
+                    self.pending.setdefault(question_id, Counter()).update(counter)
+                return
+            self.flushes += 1
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def start(self, *_):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.ensure_future(self._run())
+
+    async def shutdown(self, *_):
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        logging.info(f"Question statistics: {self.stats()}")
+
+    async def rates(self, question_ids: Optional[list[str]] = None) -> dict[str, dict]:
+        """
+        question_id -> счётчики и доли от показов: записанные в базу вместе с ещё не записанными этого процесса.
+        wrong_rate считает попытки, поэтому может быть больше 1
+        """
+        totals = {
+            question_id: Counter(counters)
+            for question_id, counters in (await repository.question_statistics(question_ids)).items()
+        }
+        for question_id, counter in self.pending.items():
+            if question_ids is None or question_id in question_ids:
+                totals.setdefault(question_id, Counter()).update(counter)
+
+        result = {}
+        for question_id, counter in totals.items():
+            shown = counter["shown"]
+            values = {name: counter[name] for name in models.STATISTIC_COUNTERS}
+            for name in models.STATISTIC_COUNTERS[1:]:
+                values[f"{name}_rate"] = round(counter[name] / shown, 4) if shown else None
+            result[question_id] = values
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self.pending),
+            "recorded": self.recorded,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes
+        }
+
+
+question_stats = QuestionStats(settings.question_stats_flush_interval)
+
+
+async def main():
+    await repository.connect()
+    print(json.dumps(await question_stats.rates(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    logger.setup_logging()
+    asyncio.run(main())
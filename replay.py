@@ -0,0 +1,135 @@
+"""
+Повтор ответов без состояния в процессе (REPEAT_MODE=session).
+Обработчик записывает в session_state не сам ответ, а его вид и аргументы: [вид, *аргументы],
+вид - имя обработчика без handler_. Повтор заново строит ответ зарегистрированной для вида функцией
+из этих аргументов и текущей сессии, поэтому следующий ход пользователя может обработать любой воркер
+"""
+from typing import Any, Awaitable, Callable, Union, get_args, get_origin
+import inspect
+import logging
+
+from aioalice.types import AliceRequest
+
+from models import RepeatKey
+from metrics import SizeStats
+from settings import settings
+from codec import codec
+from state import State
+
+# Ограничение Алисы на размер состояния сессии
+SESSION_STATE_LIMIT = 1024
+
+# вид ответа -> функция (alice, state, *аргументы), которая его строит
+renderers: dict[str, Callable[..., Awaitable[Any]]] = {}
+signatures: dict[str, inspect.Signature] = {}
+
+session_state_size = SizeStats()
+replay_size = SizeStats()
+oversized = 0
+rejected = 0
+
+
+def enabled() -> bool:
+    return settings.repeat_mode == "session"
+
+
+def renderer(kind: str):
+    def inner(func: Callable[..., Awaitable[Any]]):
+        renderers[kind] = func
+        signatures[kind] = inspect.signature(func)
+        return func
+
+    return inner
+
+
+def remember(state: State, kind: str, *args):
+    """Ответ этого хода можно повторить: аргументы только числа и короткие строки"""
+    if enabled():
+        state.session.replay = [kind, *args]
+
+
+def valid(spec: Any) -> bool:
+    """session_state присылает клиент: вид должен быть известен, а аргументы подходить его функции"""
+    if not isinstance(spec, list) or not spec or not isinstance(spec[0], str) or spec[0] not in renderers:
+        return False
+    try:
+        bound = signatures[spec[0]].bind(None, None, *spec[1:])
+    except TypeError:
+        return False
+    parameters = signatures[spec[0]].parameters
+    return all(matches(value, parameters[name].annotation) for name, value in list(bound.arguments.items())[2:])
+
+
+def matches(value: Any, annotation: Any) -> bool:
+    """Аргументы рендереров - int, bool, str или Optional от них"""
+    if get_origin(annotation) is Union:
+        return any(matches(value, arg) for arg in get_args(annotation))
+    if annotation is type(None):
+        return value is None
+    if annotation is int:
+        # bool в JSON отличается от числа, а isinstance(True, int) истинно
+        return isinstance(value, int) and not isinstance(value, bool)
+    return isinstance(value, annotation)
+
+
+async def render(alice: AliceRequest, state: State) -> Any:
+    """Последний запомненный ответ, None - повторять нечего"""
+    global rejected
+    spec = state.session.replay
+    if not spec:
+        return None
+    if not valid(spec):
+        rejected += 1
+        logging.warning(f"User: {alice.session.user_id}: unknown replay {spec!r}")
+        return None
+    kind, *args = spec
+    try:
+        # Номера ответов и фраз из аргументов тоже пришли от клиента
+        response = await renderers[kind](alice, state, *args)
+    except LookupError:
+        response = None
+    if response is None:
+        rejected += 1
+        logging.warning(f"User: {alice.session.user_id}: replay {spec!r} does not match the catalog")
+    return response
+
+
+async def repeat_data(alice: AliceRequest, state: State) -> dict:
+    """То же, что mixin_can_repeat кладёт в хранилище FSM: last, last_func и ответ под ключом RepeatKey"""
+    response = await render(alice, state)
+    if response is None:
+        return {}
+    kind = state.session.replay[0]
+    data = {RepeatKey.LAST.value: response, "last_func": f"handler_{kind}"}
+    if kind in (RepeatKey.HINT.value, RepeatKey.QUESTION.value):
+        data[kind] = response
+    return data
+
+
+def observe(response: dict):
+    """Размер session_state и данных повтора в готовом ответе"""
+    global oversized
+    session_state = response.get("session_state")
+    if not isinstance(session_state, dict):
+        return
+    size = len(codec.dumps(session_state))
+    session_state_size.observe(size)
+    if session_state.get("replay"):
+        replay_size.observe(len(codec.dumps(session_state["replay"])))
+    if size > SESSION_STATE_LIMIT:
+        oversized += 1
+        logging.warning(f"session_state is {size} bytes, Alice limit is {SESSION_STATE_LIMIT}")
+
+
+def stats() -> dict:
+    return {
+        "session_state": session_state_size.stats(),
+        "replay": replay_size.stats(),
+        "oversized": oversized,
+        "rejected": rejected
+    }
+
+
+async def log_stats(*_):
+    if enabled():
+        logging.info(f"Replay state size: {stats()}")
@@ -0,0 +1,277 @@
+from collections import Counter
+from typing import Awaitable, Callable, Optional
+import functools
+import abc
+import hashlib
+import asyncio
+import logging
+import random
+import time
+
+from beanie import PydanticObjectId
+from pymongo import UpdateOne
+
+from metrics import LatencyStats
+from settings import settings
+import models
+
+
+def timed(method: Callable[..., Awaitable]):
+    """Задержка обращения к хранилищу по имени метода, отдельно от времени обработчика"""
+
+    @functools.wraps(method)
+    async def wrapper(self: "Repository", *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await method(self, *args, **kwargs)
+        finally:
+            self.latency.setdefault(method.__name__, LatencyStats()).observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+class Repository(abc.ABC):
+    """
+    Вопросы каталога, прогресс пользователей и счётчики вопросов. Выбор непройденного вопроса (selection.py)
+    работает поверх question_ordinals и одинаков для всех хранилищ
+    """
+    name = ""
+
+    def __init__(self):
+        self.latency: dict[str, LatencyStats] = {}
+
+    @abc.abstractmethod
+    async def connect(self, *_):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_question(self, question_id: str) -> Optional[models.Question]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def all_questions(self) -> list[models.Question]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def question_ordinals(self) -> dict[str, int]:
+        """id вопроса -> Question.ordinal для всего каталога"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_user_data(self, user_id: str) -> models.UserData:
+        """Прогресс пользователя, новый пользователь создаётся"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def record_question(self, user_id: str, ordinal: int, **fields):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def reset_progress(self, user_id: str, **fields):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def bulk_progress_update(self, updates: dict):
+        """updates: user_id -> progress.ProgressUpdate"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def increment_statistics(self, counters: dict[str, Counter]):
+        """question_id -> прибавка к счётчикам QuestionStatistic"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def question_statistics(self, question_ids: Optional[list[str]] = None) -> dict[str, dict[str, int]]:
+        """question_id -> счётчики QuestionStatistic, все вопросы или только question_ids"""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {key: value.stats() for key, value in sorted(self.latency.items())}
+
+
+class MongoRepository(Repository):
+    name = "mongo"
+
+    async def connect(self, *_):
+        await models.init_database()
+        await models.assign_question_ordinals()
+
+    @timed
+    async def get_question(self, question_id: str) -> Optional[models.Question]:
+        return await models.Question.get(PydanticObjectId(question_id))
+
+    @timed
+    async def all_questions(self) -> list[models.Question]:
+        return await models.Question.find_all().to_list()
+
+    async def _read_ordinals(self) -> dict[str, Optional[int]]:
+        cursor = models.Question.get_motor_collection().find({}, {"ordinal": 1})
+        return {str(document["_id"]): document.get("ordinal") async for document in cursor}
+
+    @timed
+    async def question_ordinals(self) -> dict[str, int]:
+        ordinals = await self._read_ordinals()
+        if None in ordinals.values():
+            # Вопрос добавлен в базу в обход импорта
+            await models.assign_question_ordinals()
+            ordinals = await self._read_ordinals()
+        return ordinals
+
+    @timed
+    async def get_user_data(self, user_id: str) -> models.UserData:
+        return await models.UserData.get_user_data(user_id)
+
+    @timed
+    async def record_question(self, user_id: str, ordinal: int, **fields):
+        await models.UserData.record_question(user_id, ordinal, **fields)
+
+    @timed
+    async def reset_progress(self, user_id: str, **fields):
+        await models.UserData.reset_progress(user_id, **fields)
+
+    @timed
+    async def bulk_progress_update(self, updates: dict):
+        await models.UserData.bulk_progress_update([
+            update.to_operation(user_id) for user_id, update in updates.items()
+        ])
+
+    @timed
+    async def increment_statistics(self, counters: dict[str, Counter]):
+        await models.QuestionStatistic.get_motor_collection().bulk_write([
+            UpdateOne({"question_id": question_id}, {"$inc": dict(counter)}, upsert=True)
+            for question_id, counter in counters.items()
+        ], ordered=False)
+
+    @timed
+    async def question_statistics(self, question_ids: Optional[list[str]] = None) -> dict[str, dict[str, int]]:
+        query = {} if question_ids is None else {"question_id": {"$in": question_ids}}
+        cursor = models.QuestionStatistic.get_motor_collection().find(query, {"_id": 0})
+        return {
+            document["question_id"]: {name: document.get(name, 0) for name in models.STATISTIC_COUNTERS}
+            async for document in cursor
+        }
+
+
+class MemoryRepository(Repository):
+    """
+    Каталог из файла, прогресс и счётчики в памяти процесса, без MongoDB. Для нагрузочных тестов и профилирования:
+    у каждого воркера свой прогресс, поэтому запускать с WORKERS=1.
+    latency и jitter (секунды) имитируют медленную базу
+    """
+    name = "memory"
+
+    def __init__(self, catalog_path: Optional[str] = None, latency: float = 0.0, jitter: float = 0.0):
+        super().__init__()
+        self.catalog_path = catalog_path
+        self.latency_seconds = latency
+        self.jitter_seconds = jitter
+        self.questions: dict[str, models.Question] = {}
+        self.users: dict[str, models.UserData] = {}
+        self.statistics: dict[str, Counter] = {}
+
+    async def connect(self, *_):
+        if not self.catalog_path:
+            raise ValueError("REPOSITORY_BACKEND=memory requires CATALOG_PATH")
+        # importer импортирует catalog и selection, которые сами зависят от этого модуля
+        import importer
+        with open(self.catalog_path, encoding="utf-8") as file:
+            for entry in importer.iter_entries(file):
+                self.add_question(importer.prepare_question(entry))
+        logging.info(f"Memory repository: {len(self.questions)} questions from {self.catalog_path}")
+
+    def add_question(self, document: dict) -> models.Question:
+        question = models.build_document(models.Question, document)
+        # id из ключа вопроса: у всех воркеров и после перезапуска одинаковые
+        question.id = PydanticObjectId(hashlib.sha1(document["key"].encode()).hexdigest()[:24])
+        question.ordinal = len(self.questions)
+        self.questions[str(question.id)] = question
+        return question
+
+    async def _delay(self):
+        delay = self.latency_seconds + random.uniform(0, self.jitter_seconds)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _user(self, user_id: str) -> models.UserData:
+        user_data = self.users.get(user_id)
+        if user_data is None:
+            user_data = self.users[user_id] = models.UserData.model_construct(user_id=user_id)
+        return user_data
+
+    @timed
+    async def get_question(self, question_id: str) -> Optional[models.Question]:
+        await self._delay()
+        return self.questions.get(str(question_id))
+
+    @timed
+    async def all_questions(self) -> list[models.Question]:
+        await self._delay()
+        return list(self.questions.values())
+
+    @timed
+    async def question_ordinals(self) -> dict[str, int]:
+        await self._delay()
+        return {question_id: question.ordinal for question_id, question in self.questions.items()}
+
+    @timed
+    async def get_user_data(self, user_id: str) -> models.UserData:
+        await self._delay()
+        # Копия, как документ из базы: изменения обработчика не попадают в хранилище
+        return self._user(user_id).model_copy(deep=True)
+
+    @timed
+    async def record_question(self, user_id: str, ordinal: int, **fields):
+        await self._delay()
+        user_data = self._user(user_id)
+        user_data.mark_passed((ordinal,))
+        for name, value in fields.items():
+            setattr(user_data, name, value)
+
+    @timed
+    async def reset_progress(self, user_id: str, **fields):
+        await self._delay()
+        user_data = self._user(user_id)
+        user_data.passed = {}
+        user_data.passed_questions = []
+        for name, value in fields.items():
+            setattr(user_data, name, value)
+
+    @timed
+    async def bulk_progress_update(self, updates: dict):
+        await self._delay()
+        for user_id, update in updates.items():
+            update.apply(self._user(user_id))
+
+    @timed
+    async def increment_statistics(self, counters: dict[str, Counter]):
+        await self._delay()
+        for question_id, counter in counters.items():
+            self.statistics.setdefault(question_id, Counter()).update(counter)
+
+    @timed
+    async def question_statistics(self, question_ids: Optional[list[str]] = None) -> dict[str, dict[str, int]]:
+        await self._delay()
+        return {
+            question_id: {name: counter[name] for name in models.STATISTIC_COUNTERS}
+            for question_id, counter in self.statistics.items()
+            if question_ids is None or question_id in question_ids
+        }
+
+
+def create_repository() -> Repository:
+    if settings.repository_backend == "mongo":
+        return MongoRepository()
+    if settings.repository_backend == "memory":
+        return MemoryRepository(
+            settings.catalog_path,
+            latency=settings.repository_latency_ms / 1000,
+            jitter=settings.repository_jitter_ms / 1000
+        )
+    raise ValueError(f"Unknown repository backend {settings.repository_backend!r}")
+
+
+repository = create_repository()
+
+
+async def log_stats(*_):
+    logging.info(f"Repository {repository.name} latency: {repository.stats()}")
@@ -1,19 +1,27 @@
-from random import choice, shuffle
+from random import randrange, shuffle
 from typing import Optional
 import logging
 
 from aioalice.types import AliceRequest, Button, AliceResponse
-from aioalice.dispatcher.storage import MemoryStorage
-from beanie import PydanticObjectId
 from aioalice import Dispatcher
+from beanie import PydanticObjectId
 
 
 from mixin import mixin_appmetrica_log, mixin_can_repeat, mixin_state
 from state import State, GameStates
+from catalog import catalog
+from progress import writer
+from question_stats import question_stats
+from storage import BoundedStorage
+from settings import settings
 from models import RepeatKey
+import dispatch
+import executor
 import filters
 import models
+import replay
 import nlu
+import selection
 
 
 OK_Button = Button('Да')
@@ -32,20 +40,31 @@ POSSIBLE_ANSWER = ("Начинаем ?", "Готовы начать ?", "Пое
 CONTINUE_ANSWER = ("Продолжим ?", "Едем дальше ?")
 FACT_ANSWER = ("Хотите послушать интересный факт ?",)
 
+QUESTION_LEMMAS = set(nlu.lemmatize(["вопрос"]))
+ANSWER_LEMMAS = set(nlu.lemmatize(["ответ"]))
 
-class HybridStorage(MemoryStorage):
+
+class HybridStorage(BoundedStorage):
     async def get_state(self, user_id, alice_state: State = None):
         if alice_state is None:
-            return super().get_state(user_id)
+            return await super().get_state(user_id)
         return alice_state.session.state
 
     async def set_state(self, user_id, state: str, alice_state: State = None):
         if alice_state is None:
-            return super().set_state(user_id, state)
+            return await super().set_state(user_id, state)
         alice_state.session.state = state
 
 
-dp = Dispatcher(storage=HybridStorage())
+dp = Dispatcher(storage=HybridStorage(settings.fsm_storage_size, settings.fsm_storage_ttl))
+dispatch.install(dp)
+
+
+async def get_repeat_data(alice: AliceRequest, state: State) -> dict:
+    """Последние ответы для повтора (mixin_can_repeat): из хранилища FSM или заново по session_state"""
+    if replay.enabled():
+        return await replay.repeat_data(alice, state)
+    return await dp.storage.get_data(alice.session.user_id)
 
 
 @dp.request_handler(filters.CanDoFilter(), state="*")
@@ -54,14 +73,21 @@ dp = Dispatcher(storage=HybridStorage())
 @mixin_state
 async def handler_can_do(alice: AliceRequest, state: State, **kwargs):
     logging.info(f"User: {alice.session.user_id}: Handler->Что ты умеешь")
+    _state = await dp.storage.get_state(alice.session.user_id, state)
+    possible = None
+    if _state.upper() in ("DEFAULT_STATE", "*", "FACT"):
+        possible = randrange(len(POSSIBLE_ANSWER))
+    replay.remember(state, "can_do", possible)
+    return await render_can_do(alice, state, possible)
+
+
+@replay.renderer("can_do")
+async def render_can_do(alice: AliceRequest, state: State, possible: Optional[int]):
     answer = "Навык будет задавать вам вопросы и предлагать варианты ответов. " \
              "Для успешного прохождения навыка вам нужно ответить верно как можно больше раз. " \
              "У вас есть  возможность взять подсказку для вопроса, но количество подсказок ограничено."
-    _state = await dp.storage.get_state(alice.session.user_id, state)
-    if _state.upper() in ("DEFAULT_STATE", "*"):
-        answer = f"{answer}\n{choice(POSSIBLE_ANSWER)}"
-    if _state.upper() == "FACT":
-        answer = f"{answer}\n{choice(POSSIBLE_ANSWER)}"
+    if possible is not None:
+        answer = f"{answer}\n{POSSIBLE_ANSWER[possible]}"
     return alice.response(answer)
 
 
@@ -71,6 +97,16 @@ async def handler_can_do(alice: AliceRequest, state: State, **kwargs):
 @mixin_state
 async def handler_help(alice: AliceRequest, state: State, **kwargs):
     logging.info(f"User: {alice.session.user_id}: Handler->Помощь")
+    fsm_state = await dp.storage.get_state(alice.session.user_id, state)
+    possible = None
+    if fsm_state.upper() in ("START", "*"):
+        possible = randrange(len(POSSIBLE_ANSWER))
+    replay.remember(state, "help", possible)
+    return await render_help(alice, state, possible)
+
+
+@replay.renderer("help")
+async def render_help(alice: AliceRequest, state: State, possible: Optional[int]):
     fsm_state = await dp.storage.get_state(alice.session.user_id, state)
     if fsm_state.upper() in ("GUESS_ANSWER", "FACT", "QUESTION_TIME"):
         answer = "В данный момент вы можете попросить меня о следующем: \n" \
@@ -96,8 +132,8 @@ async def handler_help(alice: AliceRequest, state: State, **kwargs):
              "Продвигаясь все дальше вы будете отвечать на вопросы и зарабатывать баллы. " \
              "Погрузитесь в атмосферу Древнего Рима, Средневековья," \
              " Эпохи Возрождения вместе с замечательным проводником Авророй Хисторией. "
-    if fsm_state.upper() in ("START", "*"):
-        answer = f"{answer}\n{choice(POSSIBLE_ANSWER)}"
+    if possible is not None:
+        answer = f"{answer}\n{POSSIBLE_ANSWER[possible]}"
         return alice.response(answer, buttons=MENU_BUTTONS)
     return alice.response(answer)
 
@@ -131,7 +167,7 @@ def repeat_answers(alice: AliceRequest):
 
 async def repeat_question(alice: AliceRequest):
     state = State.from_request(alice)
-    question = await models.Question.get(PydanticObjectId(state.session.current_question))
+    question = await catalog.get(state.session.current_question)
     question = dict(
         text=question.full_text.src,
         tts=question.full_text.tts,
@@ -154,21 +190,21 @@ async def repeat_question(alice: AliceRequest):
 @mixin_state
 async def handler_repeat(alice: AliceRequest, state: State):
     _state = await dp.storage.get_state(alice.session.user_id, state)
-    data = await dp.storage.get_data(alice.session.user_id)
+    data = await get_repeat_data(alice, state)
     if _state.upper() in ("QUESTION_TIME", "GUESS_ANSWER", "HINT"):
         if nlu.calculate_coincidence(
-                input_tokens=nlu.lemmatize(nlu.tokenizer(alice.request.command)),
-                source_tokens=nlu.lemmatize(["вопрос"])
+                input_tokens=nlu.analyze(alice).lemma_set,
+                source_tokens=QUESTION_LEMMAS
         ) >= 1.0:
             if data.get("last_func", "") != handler_fact_confirm.__name__:
                 logging.info(f"User: {alice.session.user_id}: Handler->Повторить->Вопрос")
-                if response := data.get(RepeatKey.QUESTION, None):
+                if response := data.get(RepeatKey.QUESTION.value, None):
                     return response
                 return await repeat_question(alice)
 
         if nlu.calculate_coincidence(
-                input_tokens=nlu.lemmatize(nlu.tokenizer(alice.request.command)),
-                source_tokens=nlu.lemmatize(["ответ"])
+                input_tokens=nlu.analyze(alice).lemma_set,
+                source_tokens=ANSWER_LEMMAS
         ) >= 1.0:
             if data.get("last_func", "") != handler_fact_confirm.__name__:
                 logging.info(f"User: {alice.session.user_id}: Handler->Повторить->Ответы")
@@ -197,6 +233,12 @@ async def handler_start(alice: AliceRequest, state: State, **kwargs):
         GameStates.START,
         alice_state=state
     )
+    replay.remember(state, "start")
+    return await render_start(alice, state)
+
+
+@replay.renderer("start")
+async def render_start(alice: AliceRequest, state: State):
     answer = "Уважаемые студенты, рада видеть вас на своей лекции. " \
              "Я профессор исторических наук, Аврора Хистория. " \
              "Вы можете узнать больше, если скажите \"Помощь\" и \"Что ты умеешь?\"" \
@@ -225,14 +267,21 @@ async def handler_end(alice: AliceRequest, state: State = None, **kwargs):
         GameStates.END,
         alice_state=state
     )
+    score, question_passed = state.session.score, state.session.question_passed
+    state.session.score = 0
+    state.session.question_passed = 0
+    replay.remember(state, "end", score, question_passed)
+    return await render_end(alice, state, score, question_passed)
+
+
+@replay.renderer("end")
+async def render_end(alice: AliceRequest, state: State, score: int, question_passed: int):
     text = "Что-ж мы прибываем на конечную станцию и наше путешествие подходит к концу. \n" \
            "Это было крайне увлекательно! \n" \
            "Я давно не встречала таких интересных людей, как вы! \n" \
-           f"Вы ответили верно на {state.session.score} вопросов из {state.session.question_passed}. \n" \
+           f"Вы ответили верно на {score} вопросов из {question_passed}. \n" \
            "Спасибо за наше путешествие. Возвращайтесь почаще, наш поезд всегда вас ждёт! \n" \
            "Желаете начать заново?"
-    state.session.score = 0
-    state.session.question_passed = 0
     return alice.response(
         text, buttons=[OK_Button, REJECT_Button],
         session_state=state.session.dict()
@@ -255,31 +304,25 @@ async def handler_hint(alice: AliceRequest, state: State, **kwargs):
     # Получить ID вопроса из State-а
     # Если у пользователя достаточно баллов, даем подсказку
     # Иначе не даем
-    user_tokens = nlu.lemmatize(alice.request.nlu.tokens)
-    number_of_hints = state.session.number_of_hints
-    if number_of_hints == 0:
+    user_tokens = nlu.analyze(alice).lemma_set
+    if state.session.number_of_hints == 0:
         logging.info(f"User: {alice.session.user_id}: Handler->Подсказка->Больше нет подсказок")
-        return alice.response(f"У вас уже закончились все подсказки. ")
+        replay.remember(state, "hint", "empty", False)
+        return await render_hint(alice, state, "empty", False)
 
     fsm_state = await dp.storage.get_state(alice.session.user_id, state)
     if fsm_state.upper() == "FACT":
-        return alice.response(
-            f"У вас есть ещё {number_of_hints}  "
-            f"{nlu.declension_of_word_after_numeral('подсказка', number_of_hints)}. ",
-            buttons=[OK_Button, REJECT_Button]
-        )
+        replay.remember(state, "hint", "fact", False)
+        return await render_hint(alice, state, "fact", False)
     if "сколько" in user_tokens or "остаться" in user_tokens:
         logging.info(f"User: {alice.session.user_id}: Handler->Подсказка->Сколько осталось")
-        buttons = []
-        if fsm_state.upper() in ("QUESTION_TIME", "GUESS_ANSWER"):
-            buttons = repeat_answers(alice)["buttons"]
-        return alice.response(
-            f"У вас есть ещё {number_of_hints}  "
-            f"{nlu.declension_of_word_after_numeral('подсказка', number_of_hints)}. ",
-            buttons=buttons
-        )
+        replay.remember(state, "hint", "count", False)
+        return await render_hint(alice, state, "count", False)
 
-    if last_response := (await dp.storage.get_data(alice.session.user_id)).get(RepeatKey.HINT, None):
+    if last_response := (await get_repeat_data(alice, state)).get(RepeatKey.HINT.value, None):
+        if replay.enabled():
+            kind, variant, _ = state.session.replay
+            replay.remember(state, kind, variant, True)
         if isinstance(last_response, AliceResponse):
             if "У вас есть ещё " in last_response.response.text:
                 last_response.response.text = last_response.response.text.rsplit("\n", 1)[0]
@@ -296,19 +339,53 @@ async def handler_hint(alice: AliceRequest, state: State, **kwargs):
         state=GameStates.GUESS_ANSWER,
         alice_state=state
     )
-    question_id = state.session.current_question
-    question = await models.Question.get(PydanticObjectId(question_id))
-    answers = repeat_answers(alice)
-
+    question_stats.record(state.session.current_question, "hinted")
     state.session.number_of_hints -= 1
+    replay.remember(state, "hint", "hint", False)
+    return await render_hint(alice, state, "hint", False)
+
+
+@replay.renderer("hint")
+async def render_hint(alice: AliceRequest, state: State, variant: str, stripped: bool):
+    """
+    variant: empty - подсказки закончились, fact - сколько осталось во время факта,
+    count - сколько осталось во время вопроса, hint - сама подсказка.
+    stripped - подсказку повторили, строка с оставшимися подсказками убрана
+    """
     number_of_hints = state.session.number_of_hints
+    if variant == "empty":
+        return alice.response(f"У вас уже закончились все подсказки. ")
+    if variant == "fact":
+        return alice.response(
+            f"У вас есть ещё {number_of_hints}  "
+            f"{nlu.declension_of_word_after_numeral('подсказка', number_of_hints)}. ",
+            buttons=[OK_Button, REJECT_Button]
+        )
+    if variant == "count":
+        buttons = []
+        fsm_state = await dp.storage.get_state(alice.session.user_id, state)
+        if fsm_state.upper() in ("QUESTION_TIME", "GUESS_ANSWER"):
+            buttons = repeat_answers(alice)["buttons"]
+        return alice.response(
+            f"У вас есть ещё {number_of_hints}  "
+            f"{nlu.declension_of_word_after_numeral('подсказка', number_of_hints)}. ",
+            buttons=buttons
+        )
+
+    question = await catalog.get(state.session.current_question)
+    if question is None:
+        return None
+    answers = repeat_answers(alice)
     if number_of_hints > 0:
         left_hints = f"У вас есть ещё {number_of_hints}  " \
                      f"{nlu.declension_of_word_after_numeral('подсказка', number_of_hints)}. "
     else:
         left_hints = "К сожалению, у вас не осталось больше подсказок. "
+    text = " \n".join(("Подсказка: ", question.hint.src, left_hints))
+    if stripped and "У вас есть ещё " in text:
+        text = text.rsplit("\n", 1)[0]
     return alice.response(
-        " \n".join(("Подсказка: ", question.hint.src, left_hints)),
+        text,
         tts=" \n".join((
             '<speaker audio="dialogs-upload/97e0871e-cf33-4da5-9146-a8fa353b965e/026b63b2-162e-4d0a-a60a-735b10adb15f.opus">',
             "Подсказка: ", question.hint.tts, left_hints)),
@@ -361,26 +438,69 @@ async def handler_question(alice: AliceRequest, state: State, **kwargs):
         state=GameStates.GUESS_ANSWER,
         alice_state=state
     )
-    user_data = await models.UserData.get_user_data(alice.session.user_id)
-    data = await models.Question.aggregate([
-        {'$match': {'_id': {'$nin': user_data.passed_questions}}},
-        {"$sample": {"size": 1}}
-    ]).to_list()
-
-    if len(data) == 0:
-        logging.info(f"User: {alice.session.user_id}: Handler->Получение вопроса->вопросы закончились")
-        user_data.passed_questions = []
-        await user_data.save()
-        return await handler_end(alice, state=state)
-
-    question: models.Question = models.Question.parse_obj(data[0])
-    await user_data.add_passed_question(question.id)
+    ids = await selection.question_ids.get()
+    # Снимок вместе с ids: перечитывание каталога во время await ниже заменит question_ids.ordinals
+    ordinals = selection.question_ids.ordinals
+    progress = state.session
+    if progress.selection_seed is None or progress.selection_size != len(ids):
+        # Первый вопрос сессии или изменился каталог: прогресс читается из базы
+        progress = await writer.get_user_data(alice.session.user_id)
+    elif progress.selection_verify:
+        # Круг сверяется с пройденными: из базы нужны только они, а курсор берётся из сессии -
+        # в базе он может отставать, пока запись ждёт в очереди другого воркера (PROGRESS_WRITE_BEHIND)
+        progress = await writer.get_user_data(alice.session.user_id)
+        selection.load_from_session(progress, state.session)
+    question: Optional[models.Question] = None
+    while question is None:
+        question_id = selection.next_question_id(progress, ids, ordinals)
+        if question_id is None:
+            logging.info(f"User: {alice.session.user_id}: Handler->Получение вопроса->вопросы закончились")
+            selection.reset(progress)
+            await writer.reset_progress(alice.session.user_id, **selection.export(progress))
+            selection.save_to_session(progress, state.session)
+            return await handler_end(alice, state=state)
+        # None - вопрос удалён из каталога после чтения списка id
+        question = await catalog.get(question_id)
+
+    await writer.record_question(
+        alice.session.user_id, ordinals[question_id], **selection.export(progress)
+    )
+    selection.save_to_session(progress, state.session)
     state.session.question_passed += 1
     state.session.current_question = str(question.id)
+    question_stats.record(state.session.current_question, "shown")
 
-    answers = question.answers
+    answers = list(question.answers)
     shuffle(answers)
     answers = [(index, answer) for index, answer in enumerate(answers, 1)]
+    state.session.current_answers = [(i, answer.text.src) for i, answer in answers]
+    state.session.current_true_answer = [i for i, answer in answers if answer.is_true][0]
+    state.session.try_number = 0
+    if question.content_hash is None:
+        nlu.get_answer_index(state.session.current_question, state.session.current_answers)
+    else:
+        # Вопрос из importer.py: леммы ответов уже посчитаны
+        nlu.get_answer_index(
+            state.session.current_question, state.session.current_answers,
+            [answer.lemmas for _, answer in answers], question.common_words
+        )
+    replay.remember(state, "question")
+    return question_response(alice, question, answers)
+
+
+@replay.renderer("question")
+async def render_question(alice: AliceRequest, state: State):
+    """Вопрос с вариантами ответов в том порядке, в котором они были показаны, None - вопрос с тех пор изменили"""
+    question = await catalog.get(state.session.current_question)
+    if question is None:
+        return None
+    by_text = {answer.text.src: answer for answer in question.answers}
+    if any(text not in by_text for _, text in state.session.current_answers):
+        return None
+    return question_response(alice, question, [(i, by_text[text]) for i, text in state.session.current_answers])
+
+
+def question_response(alice: AliceRequest, question: models.Question, answers: list[tuple[int, models.Answer]]):
     text = question.full_text.src
     tts = " \n".join((
         question.full_text.tts, "Варианты ответов:",
@@ -399,9 +519,6 @@ async def handler_question(alice: AliceRequest, state: State, **kwargs):
         )
         for i, answer in answers]
     buttons += GAME_BUTTONS
-    state.session.current_answers = [(i, answer.text.src) for i, answer in answers]
-    state.session.current_true_answer = [i for i, answer in answers if answer.is_true][0]
-    state.session.try_number = 0
     return alice.response_big_image(
         text,
         tts=tts,
@@ -434,6 +551,7 @@ async def handler_reject_question(alice: AliceRequest, state: State, **kwargs):
 )
 @mixin_appmetrica_log(dp)
 async def handler_skip_question(alice: AliceRequest):
+    question_stats.record(State.from_request(alice).session.current_question, "skipped")
     return await handler_question(alice)
 
 
@@ -460,7 +578,7 @@ async def handler_dont_know_answer(alice: AliceRequest):
 )
 @mixin_can_repeat(dp)
 async def handler_quess_answer(alice: AliceRequest):
-    result = nlu.check_user_answer(alice)
+    result = await executor.check_user_answer(alice)
     if not isinstance(result, models.UserCheck):
         return await handler_answer_brute_force(alice)
 
@@ -476,17 +594,29 @@ async def handler_true_answer(alice: AliceRequest, state: State, **kwargs):
     # Если ответ верный, добавить балл
     logging.info(f"User: {alice.session.user_id}: Handler->Отгадал ответ")
     state.session.score += 1
+    question_stats.record(state.session.current_question, "correct")
 
     await dp.storage.set_state(
         alice.session.user_id,
         state=GameStates.FACT,
         alice_state=state
     )
+    fact = randrange(len(FACT_ANSWER))
+    replay.remember(state, "true_answer", fact)
+    return await render_true_answer(alice, state, fact)
+
+
+@replay.renderer("true_answer")
+async def render_true_answer(alice: AliceRequest, state: State, fact: int):
     session = state.session
     answer_text = session.current_answers[session.current_true_answer - 1][1]
-    question = await models.Question.get(PydanticObjectId(session.current_question))
-    answer = [answer for answer in question.answers if answer.text.src == answer_text][0]
-    fact_text = choice(FACT_ANSWER)
+    question = await catalog.get(session.current_question)
+    if question is None:
+        return None
+    answer = next((answer for answer in question.answers if answer.text.src == answer_text), None)
+    if answer is None:
+        return None
+    fact_text = FACT_ANSWER[fact]
     return alice.response(
         " \n".join((answer.description.src, fact_text)),
         tts=" \n".join((
@@ -506,12 +636,18 @@ async def handler_answer_brute_force(alice: AliceRequest, state: State, **kwargs
         state=GameStates.GUESS_ANSWER,
         alice_state=state
     )
+    reminder = state.session.number_of_hints > 0 and state.session.try_number < 1
+    replay.remember(state, "answer_brute_force", reminder)
+    return await render_answer_brute_force(alice, state, reminder)
+
 
+@replay.renderer("answer_brute_force")
+async def render_answer_brute_force(alice: AliceRequest, state: State, reminder: bool):
     answers = repeat_answers(alice)
     additional_text = ["Хорошая попытка, но попробуйте выбрать один из вариантов ответов. ", answers["text"]]
     buttons = answers["buttons"]
     buttons += GAME_BUTTONS
-    if state.session.number_of_hints > 0 and state.session.try_number < 1:
+    if reminder:
         additional_text.append("\nНапоминаю, что вы можете использовать подсказку. ")
         buttons.append(HINT_Button)
 
@@ -530,41 +666,64 @@ async def handler_false_answer(alice: AliceRequest, diff: Optional[models.Diff],
     # Получить ID вопроса из State-а
     # Если ответ неверный, предложить подсказку или отказаться
     if not diff:
+        # handler_all строит ответ по своему State, запоминается в этом, который попадёт в ответ
+        replay.remember(state, "all")
         return await handler_all(alice)
+    question_stats.record(state.session.current_question, "wrong")
 
     await dp.storage.set_state(
         alice.session.user_id,
         state=GameStates.GUESS_ANSWER,
         alice_state=state
     )
-    question = await models.Question.get(PydanticObjectId(state.session.current_question))
-    answer = [answer for answer in question.answers if answer.text.src == diff.answer][0]
+    question = await catalog.get(state.session.current_question)
+    answer = [index for index, answer in enumerate(question.answers) if answer.text.src == diff.answer][0]
 
-    additional_text = []
-    buttons = []
-    if state.session.number_of_hints > 0 and state.session.try_number < 1:
+    number_of_hints, try_number = state.session.number_of_hints, state.session.try_number
+    fact = None
+    if number_of_hints > 0 and try_number < 1:
         logging.info(f"User: {alice.session.user_id}: Handler->Не отгадал ответ")
-        additional_text.append("Попробуйте ещё раз отгадать ответ. ")
-        additional_text.append("Напоминаю, что вы можете использовать подсказку. ")
-        buttons += GAME_BUTTONS
-        buttons += repeat_answers(alice)["buttons"]
-    elif state.session.number_of_hints <= 0 and state.session.try_number <= 1:
-        additional_text.append("Попробуйте ещё раз отгадать ответ. ")
-        buttons += GAME_BUTTONS[1:]
-        buttons += repeat_answers(alice)["buttons"]
-    else:
+    elif number_of_hints > 0 or try_number > 1:
         logging.info(f"User: {alice.session.user_id}: Handler->Не отгадал ответ 2 раза")
         await dp.storage.set_state(
             alice.session.user_id,
             state=GameStates.FACT,
             alice_state=state
         )
+        fact = randrange(len(FACT_ANSWER))
+
+    # Без факта: попытка не последняя, напоминание о подсказке, если они остались
+    reminder = number_of_hints > 0
+    state.session.try_number += 1
+    replay.remember(state, "false_answer", answer, reminder, fact)
+    return await render_false_answer(alice, state, answer, reminder, fact)
+
+
+@replay.renderer("false_answer")
+async def render_false_answer(alice: AliceRequest, state: State, answer: int, reminder: bool, fact: Optional[int]):
+    """answer - номер выбранного ответа в question.answers, fact - попытки кончились, показан верный ответ"""
+    question = await catalog.get(state.session.current_question)
+    if question is None or not 0 <= answer < len(question.answers):
+        return None
+    answer = question.answers[answer]
+
+    additional_text = []
+    buttons = []
+    if fact is not None:
         true_answer = state.session.current_answers[state.session.current_true_answer - 1]
         additional_text.append(f"Верный ответ был: {true_answer[1]} ")
-        additional_text.append(choice(FACT_ANSWER))
+        additional_text.append(FACT_ANSWER[fact])
         buttons = [OK_Button, REJECT_Button]
+    elif reminder:
+        additional_text.append("Попробуйте ещё раз отгадать ответ. ")
+        additional_text.append("Напоминаю, что вы можете использовать подсказку. ")
+        buttons += GAME_BUTTONS
+        buttons += repeat_answers(alice)["buttons"]
+    else:
+        additional_text.append("Попробуйте ещё раз отгадать ответ. ")
+        buttons += GAME_BUTTONS[1:]
+        buttons += repeat_answers(alice)["buttons"]
 
-    state.session.try_number += 1
     return alice.response(
         " \n".join((answer.description.src, *additional_text)),
         tts=" \n".join((
@@ -584,14 +743,25 @@ async def handler_false_answer(alice: AliceRequest, diff: Optional[models.Diff],
 async def handler_fact_confirm(alice: AliceRequest, state: State, **kwargs):
     logging.info(f"User: {alice.session.user_id}: Handler->Отправка факта")
     question_id = state.session.current_question
-    question = await models.Question.get(PydanticObjectId(question_id))
     state.session.current_question = None
-    continue_answer = choice(CONTINUE_ANSWER)
+    continue_answer = randrange(len(CONTINUE_ANSWER))
     await dp.storage.set_state(
         alice.session.user_id,
         state=GameStates.QUESTION_TIME,
         alice_state=state
     )
+    replay.remember(state, "fact_confirm", question_id, continue_answer)
+    return await render_fact_confirm(alice, state, question_id, continue_answer)
+
+
+@replay.renderer("fact_confirm")
+async def render_fact_confirm(alice: AliceRequest, state: State, question_id: str, continue_answer: int):
+    if not PydanticObjectId.is_valid(question_id):
+        return None
+    question = await catalog.get(question_id)
+    if question is None:
+        return None
+    continue_answer = CONTINUE_ANSWER[continue_answer]
     return alice.response(
         " \n".join((question.fact.src, continue_answer)),
         tts=" \n".join((
@@ -621,7 +791,7 @@ async def handler_fact_reject(alice: AliceRequest, **kwargs):
 @mixin_appmetrica_log(dp)
 async def handler_restart_game(alice: AliceRequest, **kwargs):
     logging.info(f"User: {alice.session.user_id}: Handler->Перезапуск игры")
-    alice._raw_kwargs["state"]["session"] = {}
+    State.reset_session(alice)
     return await handler_question(alice)
 
 
@@ -645,6 +815,11 @@ async def handler_confirm_close_game(alice: AliceRequest, **kwargs):
 @mixin_state
 async def handler_all(alice: AliceRequest, state: State):
     logging.info(f"User: {alice.session.user_id}: Handler->Общий обработчик")
+    return await render_all(alice, state)
+
+
+@replay.renderer("all")
+async def render_all(alice: AliceRequest, state: State):
     _state = await dp.storage.get_state(alice.session.user_id, state)
     if _state == GameStates.GUESS_ANSWER:
         text = "Извините, я вас не понимаю, выбирайте из доступных вариантов ответа. \n"
@@ -0,0 +1,155 @@
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional, Union
+import asyncio
+import random
+import time
+
+from repository import repository
+from state import SessionState
+from settings import settings
+import models
+
+# Позиция пользователя в каталоге: в базе (UserData) и в состоянии сессии (SessionState)
+FIELDS = ("selection_seed", "selection_cursor", "selection_size", "selection_verify")
+Progress = Union[models.UserData, SessionState]
+
+
+def _mix(value: int) -> int:
+    """splitmix64: из соседних seed получаются несвязанные числа"""
+    value = (value + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return value ^ (value >> 31)
+
+
+@dataclass(slots=True, frozen=True)
+class Permutation:
+    """
+    Псевдослучайная перестановка позиций 0..size-1: сеть Фейстеля на ближайшей степени двойки
+    с отбрасыванием значений за пределами size. Позиция по курсору считается за O(1)
+    без хранения перемешанного списка
+    """
+    size: int
+    seed: int
+    half: int
+
+    ROUNDS = 4
+
+    @classmethod
+    def from_seed(cls, seed: int, size: int) -> "Permutation":
+        bits = max(2, (size - 1).bit_length())
+        return cls(size=size, seed=seed, half=(bits + 1) // 2)
+
+    def _encrypt(self, value: int) -> int:
+        mask = (1 << self.half) - 1
+        left, right = value >> self.half, value & mask
+        for round_number in range(self.ROUNDS):
+            left, right = right, left ^ (_mix((self.seed * self.ROUNDS + round_number) ^ (right << 32)) & mask)
+        return left << self.half | right
+
+    def __getitem__(self, cursor: int) -> int:
+        value = self._encrypt(cursor)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
+
+class QuestionIds:
+    """Отсортированные id вопросов каталога и их номера, перечитываются не чаще раза в ttl секунд"""
+
+    def __init__(self, loader: Callable[[], Awaitable[dict[str, int]]], ttl: Optional[float] = None):
+        self.loader = loader
+        self.ttl = ttl
+        self.ids: list[str] = []
+        self.ordinals: dict[str, int] = {}
+        self.loaded_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    def is_stale(self) -> bool:
+        if self.loaded_at is None:
+            return True
+        return self.ttl is not None and time.monotonic() - self.loaded_at > self.ttl
+
+    async def get(self) -> list[str]:
+        if self.is_stale():
+            # Под замком: одновременные запросы ждут одно чтение
+            async with self._lock:
+                if self.is_stale():
+                    ordinals = await self.loader()
+                    # ids и ordinals меняются вместе, без await между ними
+                    self.ids, self.ordinals = sorted(ordinals), ordinals
+                    self.loaded_at = time.monotonic()
+        return self.ids
+
+    def invalidate(self):
+        self.loaded_at = None
+
+
+question_ids = QuestionIds(repository.question_ordinals, settings.question_cache_ttl)
+
+
+def new_seed() -> int:
+    return random.getrandbits(31)
+
+
+def next_question_id(progress: Progress, ids: list[str], ordinals: dict[str, int] = None) -> Optional[str]:
+    """
+    Следующий непройденный вопрос пользователя по его перестановке каталога и курсору.
+    Изменяет курсор в progress, None - вопросы закончились.
+    Новая перестановка (старый пользователь без неё или изменившийся каталог) начинается с начала,
+    и до конца этого круга пройденные вопросы сверяются с UserData (selection_verify).
+    В остальных кругах курсор сам гарантирует отсутствие повторов
+    """
+    if progress.selection_seed is None or progress.selection_size != len(ids):
+        if progress.selection_seed is None:
+            progress.selection_seed = new_seed()
+        progress.selection_cursor = 0
+        progress.selection_size = len(ids)
+        progress.selection_verify = has_history(progress)
+    verify = progress.selection_verify
+    if verify and not isinstance(progress, models.UserData):
+        raise ValueError("selection_verify requires UserData progress")
+    # Ещё не перенесённый в битовый формат список
+    legacy = set(map(str, progress.passed_questions)) if verify and progress.passed_questions else set()
+
+    permutation = Permutation.from_seed(progress.selection_seed, len(ids))
+    while progress.selection_cursor < len(ids):
+        question_id = ids[permutation[progress.selection_cursor]]
+        progress.selection_cursor += 1
+        if not verify or not (question_id in legacy or is_passed(progress, ordinals, question_id)):
+            return question_id
+    return None
+
+
+def has_history(progress: Progress) -> bool:
+    """Есть ли пройденные вопросы, которые новая перестановка не учитывает"""
+    if not isinstance(progress, models.UserData):
+        return True
+    return bool(progress.passed or progress.passed_questions)
+
+
+def is_passed(user_data: models.UserData, ordinals: Optional[dict[str, int]], question_id: str) -> bool:
+    ordinal = (ordinals or {}).get(question_id)
+    return ordinal is not None and user_data.has_passed(ordinal)
+
+
+def reset(progress: Progress):
+    """Все вопросы пройдены: новый круг с новой перестановкой, пройденные вопросы сбрасываются"""
+    progress.selection_seed = new_seed()
+    progress.selection_cursor = 0
+    progress.selection_verify = False
+
+
+def export(progress: Progress) -> dict:
+    return {field: getattr(progress, field) for field in FIELDS}
+
+
+def save_to_session(progress: Progress, session: SessionState):
+    for field in FIELDS:
+        setattr(session, field, getattr(progress, field))
+
+
+def load_from_session(progress: Progress, session: SessionState):
+    """Позиция из сессии: она не старше той, что в базе"""
+    for field in FIELDS:
+        setattr(progress, field, getattr(session, field))
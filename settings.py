@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic_settings import BaseSettings
 from pydantic import Field
 
@@ -9,5 +11,61 @@ class Settings(BaseSettings):
 
     mongodb_url: str = Field(..., alias="MONGODB_URL")
 
+    # json | orjson | ujson
+    json_codec: str = Field("json", alias="JSON_CODEC")
+
+    # verbose | structured
+    log_mode: str = Field("verbose", alias="LOG_MODE")
+    log_sample_rate: float = Field(1.0, alias="LOG_SAMPLE_RATE")
+    log_handler_sample_rates: dict[str, float] = Field(default_factory=dict, alias="LOG_HANDLER_SAMPLE_RATES")
+    log_max_payload: int = Field(512, alias="LOG_MAX_PAYLOAD")
+
+    lemma_cache_size: int = Field(10000, alias="LEMMA_CACHE_SIZE")
+    # lru | fifo
+    lemma_cache_eviction: str = Field("lru", alias="LEMMA_CACHE_EVICTION")
+    answer_index_cache_size: int = Field(1000, alias="ANSWER_INDEX_CACHE_SIZE")
+
+    # Нечёткое сравнение лемм после точного, порог - сходство слов по расстоянию правки
+    fuzzy_matching: bool = Field(False, alias="FUZZY_MATCHING")
+    fuzzy_threshold: float = Field(0.6, alias="FUZZY_THRESHOLD")
+    fuzzy_candidates: int = Field(5, alias="FUZZY_CANDIDATES")
+    fuzzy_min_length: int = Field(4, alias="FUZZY_MIN_LENGTH")
+
+    # Кэш вопросов каталога: размер и время жизни записи в секундах
+    question_cache_size: int = Field(1000, alias="QUESTION_CACHE_SIZE")
+    question_cache_ttl: Optional[float] = Field(600, alias="QUESTION_CACHE_TTL")
+
+    # Отложенная запись прогресса пользователей: размер очереди и интервал сброса в секундах
+    progress_write_behind: bool = Field(True, alias="PROGRESS_WRITE_BEHIND")
+    progress_flush_size: int = Field(100, alias="PROGRESS_FLUSH_SIZE")
+    progress_flush_interval: float = Field(1.0, alias="PROGRESS_FLUSH_INTERVAL")
+
+    # Где выполняется проверка ответа и лемматизация: inline | thread | process
+    nlu_executor: str = Field("inline", alias="NLU_EXECUTOR")
+    nlu_executor_workers: int = Field(2, alias="NLU_EXECUTOR_WORKERS")
+    # Команды короче этого числа токенов всегда обрабатываются в цикле событий
+    nlu_offload_min_tokens: int = Field(8, alias="NLU_OFFLOAD_MIN_TOKENS")
+
+    # Хранилище вопросов и прогресса: mongo | memory (каталог из CATALOG_PATH, для нагрузочных тестов)
+    repository_backend: str = Field("mongo", alias="REPOSITORY_BACKEND")
+    # Искусственная задержка каждого обращения к memory: latency + случайная от 0 до jitter, в мс
+    repository_latency_ms: float = Field(0.0, alias="REPOSITORY_LATENCY_MS")
+    repository_jitter_ms: float = Field(0.0, alias="REPOSITORY_JITTER_MS")
+
+    # Как часто счётчики вопросов (question_stats.py) пишутся в базу, в секундах
+    question_stats_flush_interval: float = Field(5.0, alias="QUESTION_STATS_FLUSH_INTERVAL")
+
+    # Хранилище FSM и последних ответов для повтора: число пользователей и время жизни записи в секундах
+    fsm_storage_size: int = Field(10000, alias="FSM_STORAGE_SIZE")
+    fsm_storage_ttl: Optional[float] = Field(3600, alias="FSM_STORAGE_TTL")
+    # Где хранится последний ответ для повтора: storage - в хранилище FSM воркера,
+    # session - вид ответа и аргументы в session_state (replay.py), любой воркер обслужит следующий ход
+    repeat_mode: str = Field("storage", alias="REPEAT_MODE")
+
+    dispatch_trace: bool = Field(False, alias="DISPATCH_TRACE")
+
+    # Файл каталога вопросов (как Код/questions.json) для прогрева до fork
+    catalog_path: Optional[str] = Field(None, alias="CATALOG_PATH")
+
 
 settings = Settings()
@@ -1,9 +1,13 @@
-from typing import Optional
+from typing import Optional, Any
 
 from aioalice.utils.helper import Helper, HelperMode, Item
-from pydantic import BaseModel, conint, Field
+from pydantic import BaseModel, conint, Field, field_validator
 from aioalice.types import AliceRequest
 
+from context import get_body
+
+STATE_KEY = "_state"
+
 
 class SessionState(BaseModel):
     current_answers: Optional[list[tuple[int, str]]] = Field(default_factory=list)
@@ -14,6 +18,20 @@ class SessionState(BaseModel):
     try_number: int = 0
     score: Optional[conint(ge=0)] = Field(0)
     state: str = "*"
+    # Курсор выбора вопросов (selection.py), чтобы не читать его из базы на каждом вопросе сессии
+    selection_seed: Optional[int] = None
+    selection_cursor: int = 0
+    selection_size: int = 0
+    # Пока True, вопрос выбирается по UserData: нужны пройденные вопросы из базы
+    selection_verify: bool = False
+    # Последний ответ для повтора при REPEAT_MODE=session: [вид, *аргументы] (replay.py)
+    replay: Optional[list] = None
+
+    @field_validator("replay", mode="before")
+    @classmethod
+    def replay_list(cls, value: Any) -> Optional[list]:
+        # Вид и аргументы проверяет replay.render, здесь чужое значение не должно ронять разбор всего состояния
+        return value if isinstance(value, list) else None
 
 
 class UserState(BaseModel):
@@ -21,13 +39,42 @@ class UserState(BaseModel):
 
 
 class State(BaseModel):
-    session: SessionState = SessionState()
-    user: UserState = UserState()
+    session: SessionState = Field(default_factory=SessionState)
+    user: UserState = Field(default_factory=UserState)
     application: dict = Field(default_factory=dict)
 
     @classmethod
-    def from_request(cls, alice: AliceRequest):
-        return cls(**alice._raw_kwargs["state"])
+    def from_request(cls, alice: AliceRequest) -> "State":
+        """
+        Состояние разбирается один раз на запрос: обработчики, NLU и webhook
+        читают и меняют один и тот же экземпляр
+        """
+        state = alice.__dict__.get(STATE_KEY, None)
+        if state is None:
+            state = alice.__dict__[STATE_KEY] = cls.model_validate(get_body(alice)["state"])
+        return state
+
+    @classmethod
+    def reset_session(cls, alice: AliceRequest):
+        """Новая сессия посреди запроса (перезапуск игры): и в теле запроса, и в общем State"""
+        get_body(alice)["state"]["session"] = {}
+        cls.from_request(alice).session = SessionState()
+
+
+def commit_state(response: Any, alice: AliceRequest) -> Any:
+    """Дополняет session_state ответа состоянием сессии запроса"""
+    data = get_body(alice).get("state", {}).get("session", {})
+    if not data or not isinstance(response, dict):
+        return response
+
+    # Общий State запроса: без повторного разбора и с изменениями обработчиков
+    state = State.from_request(alice).session.dict()
+    body_state = response.get("session_state", {})
+    if isinstance(body_state, dict):
+        response["session_state"] = state | body_state
+    else:
+        response["session_state"] = state
+    return response
 
 
 class GameStates(Helper):
@@ -0,0 +1,70 @@
+from typing import Any, Optional
+import logging
+
+from aioalice.dispatcher.storage import BaseStorage, DEFAULT_STATE
+from aioalice.types import AliceResponse
+
+from cache import LRUCache
+from codec import codec
+
+
+def encode_data(data: dict) -> bytes:
+    """Данные пользователя в JSON: ответы (AliceResponse) хранятся как словари"""
+    return codec.dumps({
+        key: value.to_json() if isinstance(value, AliceResponse) else value
+        for key, value in data.items()
+    })
+
+
+class BoundedStorage(BaseStorage):
+    """
+    Хранилище FSM в памяти воркера с ограничением числа пользователей (LRU) и временем жизни записи (ttl секунд).
+    Данные хранятся сериализованными, get_data каждый раз возвращает новый словарь:
+    изменения в нём не попадают в хранилище без set_data. Ключи данных - строки
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: Optional[float] = 3600):
+        # user_id -> (state, данные в JSON)
+        self.cache = LRUCache(maxsize, ttl=ttl)
+
+    async def close(self):
+        self.cache.clear()
+
+    async def wait_closed(self):
+        pass
+
+    def _get(self, user_id: str) -> tuple[str, Optional[bytes]]:
+        return self.cache.get(user_id, (DEFAULT_STATE, None))
+
+    def _set(self, user_id: str, state: str, data: Optional[bytes]):
+        # Записи неактивных пользователей освобождаются, не дожидаясь вытеснения по размеру
+        self.cache.expire_oldest()
+        self.cache.set(user_id, (state, data))
+
+    async def get_state(self, user_id: str) -> str:
+        return self._get(user_id)[0]
+
+    async def set_state(self, user_id: str, state: str):
+        self._set(user_id, state, self._get(user_id)[1])
+
+    async def get_data(self, user_id: str) -> dict[str, Any]:
+        data = self._get(user_id)[1]
+        return {} if data is None else codec.loads(data)
+
+    async def set_data(self, user_id: str, data: dict):
+        self._set(user_id, self._get(user_id)[0], encode_data(data) if data else None)
+
+    async def update_data(self, user_id: str, data: Optional[dict] = None, **kwargs):
+        current = await self.get_data(user_id)
+        current.update(data or {}, **kwargs)
+        await self.set_data(user_id, current)
+
+    def stats(self) -> dict:
+        entries = list(self.cache.data.items())
+        return {
+            **self.cache.stats(),
+            "bytes": sum(len(user_id) + len(state) + len(data or b"") for user_id, (state, data) in entries)
+        }
+
+    async def log_stats(self, *_):
+        logging.info(f"FSM storage: {self.stats()}")
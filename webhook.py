@@ -0,0 +1,50 @@
+import logging
+from typing import Union
+
+from aioalice.dispatcher import webhook
+from aioalice.types import AliceRequest, AliceResponse, Response
+from aiohttp import web
+
+from context import read_body
+from state import commit_state
+from codec import codec
+import replay
+
+
+class WebhookRequestHandler(webhook.WebhookRequestHandler):
+    async def parse_request(self):
+        data = await read_body(self.request)
+        try:
+            return AliceRequest(self.request, **data)
+        except Exception:
+            logging.exception(f"Exception loading AliceRequest from\n{data!r}")
+            raise
+
+    def get_response(self, result: Union[AliceResponse, dict], request: AliceRequest) -> dict:
+        # Стадия фиксации состояния: состояние сессии прикрепляется к ответу до сериализации
+        return commit_state(super().get_response(result, request), request)
+
+    async def post(self):
+        request = await self.parse_request()
+        result = await self.process_request(request)
+        response = self.get_response(result, request)
+        if replay.enabled():
+            replay.observe(response)
+        return web.Response(body=codec.dumps(response), content_type="application/json")
+
+
+def configure_app(app: web.Application, dispatcher, path: str = webhook.DEFAULT_WEB_PATH,
+                  default_response_or_text: str = webhook.DEFAULT_ERROR_RESPONSE_TEXT):
+    # Повторяет aioalice.configure_app, но с обработчиком, читающим общее тело запроса
+    app.on_shutdown.append(dispatcher.shutdown)
+    app.router.add_route("*", path, WebhookRequestHandler, name="alice_webhook_handler")
+    app[webhook.ALICE_DISPATCHER_KEY] = dispatcher
+    app[webhook.ERROR_RESPONSE_KEY] = Response(default_response_or_text)
+    return app
+
+
+def get_new_configured_app(dispatcher, path: str = webhook.DEFAULT_WEB_PATH,
+                           default_response_or_text: str = webhook.DEFAULT_ERROR_RESPONSE_TEXT):
+    app = web.Application()
+    configure_app(app, dispatcher, path, default_response_or_text)
+    return app